@@ -0,0 +1,302 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Measures the throughput of manga.py against a local stand-in of InManga, without connecting to the real website.
+# Example: python3 benchmark.py --chapters 20 --pages 30 --latency 0.1 --workers 8 --formats PDF CBZ
+
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import importlib.util
+import importlib.machinery
+from urllib.parse import urlparse, parse_qs
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+MANGA_TITLE = 'Benchmark Manga'
+MANGA_UUID = '00000000-0000-0000-0000-000000000000'
+
+IMAGE_VARIANTS = 8
+
+def set_args():
+  global args
+  parser = argparse.ArgumentParser(prog='benchmark.py', description='Benchmark manga.py with a local InManga stand-in server')
+  parser.add_argument("--chapters", type=int, default=10, help="Number of chapters of the benchmark manga [Default = 10]")
+  parser.add_argument("--pages", type=int, default=20, help="Number of pages of every chapter [Default = 20]")
+  parser.add_argument("--image-size", default='800x1200', help="Width x height of the page images in pixels [Default = 800x1200]")
+  parser.add_argument("--latency", type=float, default=0.05, help="Seconds the server waits before every response [Default = 0.05]")
+  parser.add_argument("--formats", nargs='+', default=['PDF'], help="Formats to convert the downloaded chapters to, every format is a stage [Default = PDF]")
+  parser.add_argument("--script", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'manga.py'), help="manga.py script to benchmark")
+  parser.add_argument("--json", help="Write the report to this JSON file")
+  parser.add_argument("--keep", action='store_true', help="Do not remove the downloaded chapters")
+  parser.add_argument("--parse", action='store_true', help="Compare the HTML parsers of manga.py (fast path and BeautifulSoup) instead of running the stages")
+  parser.add_argument("--iterations", type=int, default=200, help="Iterations of every parser with --parse [Default = 200]")
+  parser.add_argument("--processed", action='store_true', help="Check that the pages processed by KCC for --processed-cache keep the order of the chapter, with a stand-in KCC that writes them out of order, instead of running the stages")
+  args, manga_args = parser.parse_known_args()
+  args.manga_args = manga_args # other arguments are passed to manga.py, e.g. --workers 8
+
+def png(width, height, seed):
+  # random noise, so images are not compressed more than real pages
+  rnd = random.Random(seed)
+  row_size = width * 3
+  raw = b''.join(b'\0' + bytes(rnd.getrandbits(8) for _ in range(row_size)) for _ in range(height))
+  def chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+  header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+  return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b'')
+
+def chapter_id(chapter):
+  return f'chapter-{chapter}'
+
+def page_id(chapter, page):
+  return f'{chapter_id(chapter)}-page-{page}'
+
+def search_result_html(title, uuid):
+  return f'''<a href="/ver/manga/{title.replace(" ", "-")}/{uuid}" class="manga-result">
+  <div class="media-box"><img class="lazy" data-src="/thumbnails/manga/{uuid}" alt="{title}"></div>
+  <div class="list-group-item"><h4 class="m0 ellipsed-text">{title}</h4><span class="label label-success">En emisión</span></div>
+</a>'''
+
+def search_html(results=1):
+  # the benchmark manga and other similar titles
+  other_results = [search_result_html(f'{MANGA_TITLE} {result}', f'{result:08d}-0000-0000-0000-000000000000') for result in range(1, results)]
+  return '\n'.join([search_result_html(MANGA_TITLE, MANGA_UUID)] + other_results)
+
+def catalog_json(results=10):
+  # like QSMangaList.json, the benchmark manga and other similar titles
+  catalog = [{ 'Name': MANGA_TITLE, 'Identification': MANGA_UUID }]
+  catalog += [{ 'Name': f'{MANGA_TITLE} {result}', 'Identification': f'{result:08d}-0000-0000-0000-000000000000' } for result in range(1, results)]
+  return json.dumps(catalog)
+
+def chapters_json(chapters):
+  result = [{ 'Number': chapter, 'Identification': chapter_id(chapter) } for chapter in range(1, chapters + 1)]
+  return json.dumps({ 'data': json.dumps({ 'result': result }) })
+
+def chapter_pages_html(chapter, pages, chapters):
+  # like chapterIndexControls, which also lists all the chapters
+  chapter_options = ''.join(f'<option value="{chapter_id(other)}"{" selected" if other == chapter else ""}>{other}</option>\n' for other in range(1, chapters + 1))
+  page_options = ''.join(f'<option value="{page_id(chapter, page)}">{page}</option>\n' for page in range(1, pages + 1))
+  return f'''<div class="chapter-controls row">
+  <div class="col-xs-6"><select id="ChapList" class="form-control ChapterListClass">\n{chapter_options}</select></div>
+  <div class="col-xs-3"><select id="PageList" class="form-control PageListClass">\n{page_options}</select></div>
+  <div class="col-xs-3"><a class="btn btn-primary" href="#" id="NextPage">Siguiente</a></div>
+</div>'''
+
+class Stats:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.requests = 0
+    self.bytes = 0
+  def add(self, size):
+    with self.lock:
+      self.requests += 1
+      self.bytes += size
+  def snapshot(self):
+    with self.lock:
+      return self.requests, self.bytes
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+def start_server(chapters, pages, images, latency):
+  stats = Stats()
+  class InMangaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+    def log_message(self, *_):
+      pass
+    def respond(self, body, content_type, status=200):
+      time.sleep(latency)
+      if isinstance(body, str):
+        body = body.encode('utf-8')
+      self.send_response(status)
+      self.send_header('Content-Type', content_type)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+      stats.add(len(body))
+    def do_POST(self):
+      self.rfile.read(int(self.headers.get('Content-Length', 0)))
+      if self.path.startswith('/manga/getMangasConsultResult'):
+        self.respond(search_html(), 'text/html; charset=utf-8')
+      else:
+        self.respond('Not Found', 'text/plain', 404)
+    def do_GET(self):
+      url = urlparse(self.path)
+      identification = parse_qs(url.query).get('identification', parse_qs(url.query).get('mangaIdentification', ['']))[0]
+      if url.path == '/chapter/getall':
+        self.respond(chapters_json(chapters), 'application/json; charset=utf-8')
+      elif url.path == '/OnMangaQuickSearch/Source/QSMangaList.json':
+        self.respond(catalog_json(), 'application/json; charset=utf-8')
+      elif url.path == '/chapter/chapterIndexControls':
+        chapter = int(identification.split('-')[-1])
+        self.respond(chapter_pages_html(chapter, pages, chapters), 'text/html; charset=utf-8')
+      elif url.path.startswith('/page/getPageImage'):
+        self.respond(images[hash(identification) % len(images)], 'image/png')
+      else:
+        self.respond('Not Found', 'text/plain', 404)
+  server = ThreadingHTTPServer(('127.0.0.1', 0), InMangaHandler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server, stats
+
+def run_stage(name, argv, env, stats):
+  # wall time, peak RSS and served requests of one manga.py run
+  requests_before, bytes_before = stats.snapshot()
+  start = time.perf_counter()
+  stderr = tempfile.TemporaryFile()
+  process = subprocess.Popen([sys.executable] + argv, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr)
+  peak_rss = None
+  if hasattr(os, 'wait4'):
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status >> 8
+    # kilobytes on Linux, bytes on macOS
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+  else:
+    process.wait()
+  elapsed = time.perf_counter() - start
+  requests_after, bytes_after = stats.snapshot()
+  if process.returncode != 0:
+    stderr.seek(0)
+    print(stderr.read().decode('utf-8', 'replace'), file=sys.stderr)
+    sys.exit(f'Stage {name} failed with exit code {process.returncode}')
+  return {
+    'stage': name,
+    'seconds': elapsed,
+    'requests': requests_after - requests_before,
+    'bytes': bytes_after - bytes_before,
+    'peak_rss': peak_rss
+  }
+
+def load_script(path):
+  spec = importlib.util.spec_from_file_location('manga', path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def benchmark_parsers():
+  # chapter pages and search HTML fixtures like the ones served by the stand-in server
+  import timeit
+  manga = load_script(args.script)
+  fixtures = [
+    ('page list', chapter_pages_html(1, args.pages, args.chapters).encode('utf-8'), manga.parse_page_list, manga.parse_page_list_soup),
+    ('search', search_html(10), manga.parse_search, manga.parse_search_soup)
+  ]
+  print(f"{'FIXTURE':<12}{'FAST':>12}{'SOUP':>12}{'SPEEDUP':>10}")
+  for name, fixture, fast_parser, soup_parser in fixtures:
+    if fast_parser(fixture) != soup_parser(fixture):
+      sys.exit(f'Parsers do not match for {name} fixture')
+    fast = timeit.timeit(lambda: fast_parser(fixture), number=args.iterations) / args.iterations
+    soup = timeit.timeit(lambda: soup_parser(fixture), number=args.iterations) / args.iterations
+    print(f'{name:<12}{fast * 1000:>10.3f}ms{soup * 1000:>10.3f}ms{soup / fast:>9.1f}x')
+
+def check_processed():
+  # stand-in KCC writing the CBZ entries in reverse order, the content of every entry is its page number
+  import types
+  import zipfile
+  def kcc_main(argv):
+    output, source = argv[argv.index('--output') + 1], argv[-1]
+    pages = sorted(os.listdir(source))
+    with zipfile.ZipFile(f'{output}/{os.path.basename(source)}.cbz', 'w') as cbz:
+      for number, page in reversed(list(enumerate(pages, start=1))):
+        cbz.writestr(f'{number:03d}_kcc.png', str(number))
+  kcc = types.ModuleType('kindlecomicconverter')
+  kcc.__spec__ = importlib.machinery.ModuleSpec('kindlecomicconverter', None) # found by the dependencies check of manga.py
+  kcc.comic2ebook = types.SimpleNamespace(main=kcc_main)
+  sys.modules['kindlecomicconverter'] = kcc
+  manga = load_script(args.script)
+  directory = tempfile.mkdtemp(prefix='inmangakindle-processed-')
+  try:
+    sys.argv = [args.script, MANGA_TITLE, '--directory', directory, '--processed-cache', '1024']
+    manga.set_args()
+    manga.MANGA_DIR, manga.PROCESSED_DIR = directory, f'{directory}/processed'
+    manga.manga = manga.manga_title = MANGA_TITLE
+    chapter_directory = manga.chapter_directory(MANGA_TITLE, 1)
+    os.makedirs(chapter_directory)
+    for number in range(1, args.pages + 1):
+      with open(f'{chapter_directory}/{number:03d}.png', 'wb') as handler:
+        handler.write(str(number).encode())
+    path = manga.processed_chapter(1, ['--output', directory, '-f', 'CBZ'])
+    pages = [open(f'{path}/{page}').read() for page in sorted(os.listdir(path))]
+    if pages != [str(number) for number in range(1, args.pages + 1)]:
+      sys.exit(f'Processed pages are out of order: {pages}')
+    print(f'Processed pages keep the order of the chapter ({len(pages)} pages)')
+  finally:
+    import shutil
+    shutil.rmtree(directory, ignore_errors=True)
+
+def format_bytes(size):
+  for unit in ['B', 'KB', 'MB', 'GB']:
+    if size < 1024 or unit == 'GB':
+      return f'{size:.1f} {unit}'
+    size /= 1024
+
+def print_report(report):
+  print(f"{report['chapters']} chapters x {report['pages']} pages ({format_bytes(report['image_bytes'])} per image), latency {report['latency']}s")
+  print(f"{'STAGE':<12}{'TIME':>10}{'PAGES/S':>10}{'BYTES/S':>14}{'REQUESTS':>10}{'PEAK RSS':>12}")
+  for stage in report['stages']:
+    pages_per_second = report['chapters'] * report['pages'] / stage['seconds']
+    bytes_per_second = format_bytes(stage['bytes'] / stage['seconds']) + '/s' if stage['bytes'] else '-'
+    peak_rss = format_bytes(stage['peak_rss']) if stage['peak_rss'] is not None else '-'
+    print(f"{stage['stage']:<12}{stage['seconds']:>9.2f}s{pages_per_second:>10.1f}{bytes_per_second:>14}{stage['requests']:>10}{peak_rss:>12}")
+
+if __name__ == "__main__":
+  set_args()
+
+  if args.parse:
+    benchmark_parsers()
+    sys.exit()
+
+  if args.processed:
+    check_processed()
+    sys.exit()
+
+  width, height = map(int, args.image_size.lower().split('x'))
+  print(f'Generating {IMAGE_VARIANTS} images of {width}x{height}...')
+  images = [png(width, height, seed) for seed in range(IMAGE_VARIANTS)]
+
+  server, stats = start_server(args.chapters, args.pages, images, args.latency)
+  directory = tempfile.mkdtemp(prefix='inmangakindle-benchmark-')
+  # sessions and processed pages of the user are not used, and no update check is requested from GitHub
+  env = dict(os.environ, INMANGA_WEBSITE=f'http://127.0.0.1:{server.server_address[1]}', XDG_CACHE_HOME=os.path.join(directory, '.cache'))
+  manga_argv = [args.script, MANGA_TITLE, '--directory', directory, '--no-update-check'] + args.manga_args
+
+  stages = []
+  try:
+    print('Stage download...')
+    stages.append(run_stage('download', manga_argv + ['--format', 'PNG'], env, stats))
+    for output_format in args.formats:
+      output_format = output_format.upper()
+      if output_format in ['MOBI', 'EPUB', 'CBZ'] and importlib.util.find_spec('kindlecomicconverter') is None:
+        print(f'Skipping stage {output_format}: KindleComicConverter is not installed')
+        continue
+      print(f'Stage {output_format}...')
+      stages.append(run_stage(output_format, manga_argv + ['--format', output_format, '--cache'], env, stats))
+  finally:
+    server.shutdown()
+    if not args.keep:
+      import shutil
+      shutil.rmtree(directory, ignore_errors=True)
+    else:
+      print(f'Downloads kept in {directory}')
+
+  report = {
+    'chapters': args.chapters,
+    'pages': args.pages,
+    'image_bytes': sum(map(len, images)) // len(images),
+    'latency': args.latency,
+    'manga_args': args.manga_args,
+    'stages': stages
+  }
+
+  print_report(report)
+
+  if args.json:
+    with open(args.json, 'w') as handler:
+      json.dump(report, handler, indent=2)
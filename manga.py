@@ -14,19 +14,48 @@ import re
 import sys
 import math
 import json
+import time
 import signal
+import io
+import html
+import zlib
+import struct
+import random
+import hashlib
+import unicodedata
+import atexit
+import email.utils
 import argparse
 import tempfile
 import bisect
 import platform
+import threading
+import shlex
 import subprocess
+import multiprocessing
+import concurrent.futures
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlparse
 from multiprocessing import freeze_support
+from concurrent.futures import ThreadPoolExecutor
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), NAME)
+
+DEPENDENCY_MODULES = ['requests', 'cloudscraper', 'bs4', 'colorama', 'img2pdf', 'kindlecomicconverter', 'wand']
 
 def install_dependencies(dependencies_file):
   # Check dependencies
+  # pkg_resources is slow, so dependencies are checked once for every Python interpreter and dependencies file
+  # while their modules can be found
   from pathlib import Path
-  import pkg_resources
+  import importlib.util
   dependencies_path = Path(__file__).with_name(dependencies_file)
+  checked_key = hashlib.sha1(f'{sys.executable} {sys.version}'.encode() + dependencies_path.read_bytes()).hexdigest()
+  checked_path = Path(CACHE_DIR, 'dependencies', checked_key)
+  if checked_path.exists() and all(importlib.util.find_spec(module) for module in DEPENDENCY_MODULES):
+    return
+  import pkg_resources
   dependencies = pkg_resources.parse_requirements(dependencies_path.open())
   try:
     for dependency in dependencies:
@@ -35,48 +64,105 @@ def install_dependencies(dependencies_file):
   except pkg_resources.DistributionNotFound as e:
     print("Some dependencies are missing, installing...")
     # Install missing dependencies
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "-r", dependencies_file])
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "-r", str(dependencies_path)])
+  try:
+    checked_path.parent.mkdir(parents=True, exist_ok=True)
+    checked_path.touch()
+  except OSError:
+    pass
 
 install_dependencies("dependencies.txt")
 
+# cloudscraper and bs4 are imported only when needed, so offline runs start faster
 import requests
-import cloudscraper
-from bs4 import BeautifulSoup
 from colorama import Fore, Style, init as init_console_colors
 
-PROVIDER_WEBSITE = "https://inmanga.com"
+PROVIDER_WEBSITE = os.environ.get('INMANGA_WEBSITE', "https://inmanga.com") # overridden by benchmark.py
 IMAGE_WEBSITE = f"{PROVIDER_WEBSITE}/page/getPageImage/?identification="
 CHAPTERS_WEBSITE = f"{PROVIDER_WEBSITE}/chapter/getall?mangaIdentification="
 CHAPTER_PAGES_WEBSITE = f"{PROVIDER_WEBSITE}/chapter/chapterIndexControls?identification="
 MANGA_WEBSITE = f"{PROVIDER_WEBSITE}/ver/manga"
 
-SEARCH_URL = "https://inmanga.com/manga/getMangasConsultResult"
+SEARCH_URL = f"{PROVIDER_WEBSITE}/manga/getMangasConsultResult"
+CATALOG_URL = f"{PROVIDER_WEBSITE}/OnMangaQuickSearch/Source/QSMangaList.json"
 
 MANGA_DIR = './manga'
 
 FILENAME_KEEP = set(['_', '-', ' ', '.'])
 DIRECTORY_KEEP = FILENAME_KEEP | set(['/'])
-EXTENSION_KEEP = set('.')
 
-SCRAPER = cloudscraper.create_scraper()
+CHUNK_SIZE = 64 * 1024
+
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+SCRAPER = None
+SCRAPER_LOCK = threading.Lock()
+
+PAGES_CACHE_TTL = 30 * 24 * 3600 # page lists of a chapter do not change once published
 
 CHAPTERS_FORMAT = 'Format: start..end or chapters with commas. Example: --chapter 3 will download chapter 3, --chapter last will download the last chapter available, --chapters 3..last will download chapters from 3 to the last chapter, --chapter 3 will download only chapter 3, --chapters "3, 12" will download chapters 3 and 12, --chapters "3..12, 15" will download chapters from 3 to 12 and also chapter 15.'
 
 def set_args():
-  global args
-  parser = argparse.ArgumentParser(prog=NAME, epilog=f'web: {WEBSITE}')
-  parser.add_argument("manga", help="manga to download", nargs='+')
+  global args, PARSER
+  parser = PARSER = argparse.ArgumentParser(prog=NAME, epilog=f'web: {WEBSITE}')
+  parser.add_argument("manga", help="manga to download", nargs='*')
+  parser.add_argument("--batch", help="Download many mangas in the same run, sharing the connections, caches and workers. File with the arguments of every manga in a line, like: \"One Piece\" --chapters 1..10 --format PDF. Arguments of the command line apply to all of them. A JSON list of argument lists is also accepted")
   parser.add_argument("--chapters", "--chapter", help=f'chapters to download. {CHAPTERS_FORMAT} If this argument is not provided all chapters will be downloaded.', nargs='+')
   parser.add_argument("--directory", help=f"directory to save downloads. Default: {MANGA_DIR}", default=MANGA_DIR)
   parser.add_argument("--single", action='store_true', help="merge all chapters in only one file. If this argument is not provided every chapter will be in a different file")
   parser.add_argument("--rotate", action='store_true', help="rotate double pages. If this argument is not provided double pages will be splitted in 2 different pages")
   parser.add_argument("--profile", help='Device profile (Available options: K1, K2, K34, K578, KDX, KPW, KV, KO, KoMT, KoG, KoGHD, KoA, KoAHD, KoAH2O, KoAO) [Default = KPW (Kindle Paperwhite)]', default='KPW')
   parser.add_argument("--format", help='Output format (Available options: PNG, PDF, MOBI, EPUB, CBZ) [Default = MOBI]. If PNG is selected then no conversion to e-reader file will be done', default='MOBI')
+  parser.add_argument("--raw", action='store_true', help="With --format CBZ, pack the downloaded pages as they are instead of processing them for the profile with KCC, which is much faster")
   parser.add_argument("--fullsize", action='store_true', help="Do not stretch images to the profile's device resolution")
+  parser.add_argument("--staging", choices=['link', 'copy'], default='link', help="How chapters are gathered for --single e-reader files: link (hardlinks or symlinks, copy only if links are not supported) or copy [Default = link]")
   parser.add_argument("--cache", action='store_true', help="Avoid downloading chapters and use already downloaded chapters instead (offline)")
+  parser.add_argument("--reindex", action='store_true', help="Index again the chapters downloaded in the directory, used by --cache to find them. Needed only if chapters were changed without this script")
+  parser.add_argument("--prescale", action='store_true', help="Reduce every page to the --profile resolution while downloading, in parallel processes, so pages take less space and the conversion is faster. Pages are never enlarged")
+  parser.add_argument("--dedup", action='store_true', help="Store downloaded pages only once when they are repeated in other chapters or mangas, as hardlinks to a store of pages in the directory")
+  parser.add_argument("--gc", action='store_true', help="Remove the pages of the --dedup store that are not used by any chapter anymore. Manga title is optional")
   parser.add_argument("--remove-alpha", action='store_true', help="When converting to PDF remove alpha channel on images using ImageMagick Wand")
+  parser.add_argument("--stream-pdf", action='store_true', help="When converting to PDF write pages one by one to the file instead of using img2pdf, so memory does not grow with the number of pages")
+  parser.add_argument("--workers", type=positive_int, default=1, help="Number of pages to download concurrently [Default = 1]")
+  parser.add_argument("--chapter-workers", type=positive_int, default=1, help="Number of chapters to download concurrently, sharing the --workers pool [Default = 1]")
+  parser.add_argument("--processed-cache", type=positive_int, metavar='MB', help="Keep the pages processed by KCC for the profile in a cache of this size in MB, so converting the same chapters again to other formats or --single files does not process the images again [Default = disabled]")
+  parser.add_argument("--convert-jobs", type=positive_int, default=1, help="Number of chapters to convert at the same time in different processes, sharing the CPU cores between them [Default = 1]")
+  parser.add_argument("--pipeline", action='store_true', help="Convert every chapter as soon as it is downloaded, while the next chapters are still downloading. Not compatible with --single")
+  parser.add_argument("--verify", action='store_true', help="Check downloaded chapters against their manifests and download again missing or damaged pages. Otherwise chapters with a manifest are not checked")
+  parser.add_argument("--sync", action='store_true', help="Download and convert only the chapters released after the last chapter completed by a previous --sync of this manga")
+  parser.add_argument("--cache-ttl", type=float, default=24, help="Hours to reuse cached search results before requesting them again. Chapter lists are always requested, so new chapters are found [Default = 24]")
+  parser.add_argument("--refresh", action='store_true', help="Ignore cached search results, page lists and the saved session, and request them again")
+  parser.add_argument("--timeout", type=positive_float, default=30, help="Seconds to wait for the server before retrying a request [Default = 30]")
+  parser.add_argument("--retries", type=non_negative_int, default=3, help="Number of times a request is retried after a network error or a 429/5xx response [Default = 3]")
+  parser.add_argument("--backoff", type=positive_float, default=1, help="Base seconds of the exponential backoff between retries, unless the server sends Retry-After [Default = 1]")
+  parser.add_argument("--rate-limit", type=positive_float, help="Maximum requests per second to the provider, shared by all the workers [Default = unlimited]")
+  parser.add_argument("--pool-size", type=positive_int, help="Maximum connections kept open to reuse them for the next requests to the same host [Default = --workers, --host-connections or 10, the greatest]")
+  parser.add_argument("--host-connections", type=positive_int, help="Maximum concurrent requests to the same host [Default = --workers]")
+  parser.add_argument("--metrics", help="Write a report with the time of every stage, requests, bytes transferred, retries and cache hits to this file when finished, also if cancelled. JSON, or Prometheus textfile if the file ends with .prom")
+  parser.add_argument("--no-update-check", action='store_true', help="Do not check for a new version of InMangaKindle. Never checked with --cache")
   parser.add_argument("--version", "-v", action=CheckVersion, help="Display current InMangaKindle version", version=VERSION)
   args = parser.parse_args()
+  if not args.manga and not args.batch and not args.gc:
+    parser.error('the following arguments are required: manga')
+
+def positive_int(value):
+  number = int(value)
+  if number < 1:
+    raise argparse.ArgumentTypeError(f'{value} must be greater than 0')
+  return number
+
+def non_negative_int(value):
+  number = int(value)
+  if number < 0:
+    raise argparse.ArgumentTypeError(f'{value} must be 0 or greater')
+  return number
+
+def positive_float(value):
+  number = float(value)
+  if not number > 0:
+    raise argparse.ArgumentTypeError(f'{value} must be greater than 0')
+  return number
 
 class CheckVersion(argparse.Action):
   def __init__(self, option_strings, version=VERSION, **kwargs):
@@ -91,22 +177,28 @@ class CheckVersion(argparse.Action):
       print_colored('✅ Up to date', Fore.GREEN)
     exit()
 
-def check_version():
-  latest_version = None
+def latest_release():
+  # (tag, url) of the latest release or None if it cannot be checked
   try:
-    response = requests.get(f'https://api.github.com/repos/Carleslc/{NAME}/releases/latest')
-    html_url = load_json(response.content, 'html_url')
-    latest_version = load_json(response.content, 'tag_name')
+    response = requests.get(f'https://api.github.com/repos/Carleslc/{NAME}/releases/latest', timeout=10)
+    tag = load_json(response.content, 'tag_name')
+    if tag is None:
+      return None # rate limited or not found
+    return tag, load_json(response.content, 'html_url')
   except:
-    if not args.cache:
-      print_dim(f'Cannot check for updates. Version: {VERSION}', Fore.YELLOW)
-  if latest_version is None:
+    return None
+
+def check_version(release=None, interactive=True):
+  release = release or latest_release()
+  if release is None:
+    print_dim(f'Cannot check for updates. Version: {VERSION}', Fore.YELLOW)
     return False
+  latest_version, html_url = release
   is_updated = latest_version == VERSION
   if not is_updated:
     print_colored(f'New version is available! {VERSION} -> {latest_version}', Style.BRIGHT, Fore.GREEN)
     print_colored(f'Upgrade to the latest version: {html_url}', Fore.GREEN)
-    if os.path.isdir('.git'):
+    if interactive and os.path.isdir('.git'):
       print_colored('Git detected. Do you want to checkout the new version❓ [Y/n]', Fore.YELLOW, Style.BRIGHT, end=' ')
       try:
         answer = input()
@@ -118,6 +210,20 @@ def check_version():
         print_colored(f'git fetch && git checkout {latest_version}', Fore.YELLOW)
   return is_updated
 
+UPDATE_CHECK = {}
+
+def check_version_background():
+  # the latest release is requested while downloading and only reported at exit if it was received by then
+  def check():
+    UPDATE_CHECK['release'] = latest_release()
+  def report():
+    release = UPDATE_CHECK.get('release')
+    if release is not None and release[0] != VERSION:
+      print()
+      check_version(release, interactive=False)
+  threading.Thread(target=check, daemon=True).start()
+  atexit.register(report)
+
 def is_python_version_supported():
   min_version, max_version = SUPPORT_PYTHON
   major, minor, _ = platform.python_version_tuple()
@@ -132,18 +238,14 @@ def python_not_supported():
   return f'Your Python version {platform.python_version()} is not fully supported ({sys.executable} --version). Please, use a Python version between {min_version} and {max_version}\n{RECOMMENDED_PYTHON}'
 
 def print_colored(message, *colors, end='\n'):
-  def printnoln(s):
-    print(s, end='', flush=True)
-  for color in colors:
-    printnoln(color)
-  print(message, end=end)
-  printnoln(Style.RESET_ALL)
+  # single write, so lines printed by concurrent workers are not mixed
+  print(''.join(colors) + f'{message}{end}' + Style.RESET_ALL, end='', flush=True)
 
 def error(message, tip=''):
   print_colored(message, Fore.RED, Style.BRIGHT)
   if tip:
     print_dim(tip)
-  exit()
+  exit(1)
 
 def not_found():
   error(f"Manga '{MANGA}' not found")
@@ -154,10 +256,12 @@ def print_dim(s, *colors):
 def print_source(html_soup):
   print_dim(html_soup.prettify())
 
+CANCELLED = 130
+
 def cancellable():
   def cancel(s, f):
     print_dim('\nCancelled')
-    exit()
+    exit(CANCELLED)
   try:
     signal.signal(signal.SIGINT, cancel)
   except:
@@ -183,41 +287,361 @@ def exit_if_fails(request):
   if not success(request, print_ok=False):
     exit(1)
 
-def write_file(path, data):
-  dirname = os.path.dirname(path)
-  if not os.path.exists(dirname):
-    os.makedirs(dirname)
-  with open(path, 'wb') as handler:
-    handler.write(data)
+@contextmanager
+def atomic_file(path, mode=0o666):
+  # temporary file renamed to path when the block completes or removed if it fails
+  # so readers never see a partially written file
+  dirname = os.path.dirname(path) or '.'
+  os.makedirs(dirname, exist_ok=True)
+  handler = tempfile.NamedTemporaryFile(dir=dirname, prefix='.', suffix='.part', delete=False)
+  try:
+    with handler:
+      yield handler
+    os.chmod(handler.name, mode & ~UMASK)
+    os.replace(handler.name, path)
+  except BaseException:
+    if os.path.exists(handler.name):
+      os.remove(handler.name)
+    raise
+
+def write_stream(path, response, native=False):
+  # an interrupted download never leaves a partial file
+  # with native, path has no extension and the one of the downloaded image is added
+  # returns the path of the file
+  try:
+    chunks = response.iter_content(CHUNK_SIZE)
+    header = b''
+    if native:
+      # the extension is known from the first bytes, before the file is created
+      for chunk in chunks:
+        header += chunk
+        if len(header) >= 16:
+          break
+      path = f'{path}.{image_extension(header[:16], response.headers.get("Content-Type"))}'
+    with atomic_file(path) as handler:
+      handler.write(header)
+      for chunk in chunks:
+        handler.write(chunk)
+      expected_size = response.headers.get('Content-Length')
+      size = handler.tell()
+      count('bytes', size)
+      if expected_size is not None and 'Content-Encoding' not in response.headers and size != int(expected_size):
+        raise requests.exceptions.ConnectionError(f'Incomplete download {response.url} ({size}/{expected_size} bytes)', response=response)
+    return path
+  except requests.exceptions.ChunkedEncodingError as e:
+    raise requests.exceptions.ConnectionError(e, response=response)
+  finally:
+    response.close()
+
+PAGE_EXTENSIONS = ('png', 'jpg', 'webp', 'gif')
+IMAGE_CONTENT_TYPES = { 'image/png': 'png', 'image/jpeg': 'jpg', 'image/jpg': 'jpg', 'image/webp': 'webp', 'image/gif': 'gif' }
+
+def image_extension(header, content_type=None):
+  # from the magic bytes, then the Content-Type, png if unknown
+  if header.startswith(PNG_SIGNATURE):
+    return 'png'
+  if header.startswith(JPEG_SIGNATURE):
+    return 'jpg'
+  if header.startswith(b'RIFF') and header[8:12] == b'WEBP':
+    return 'webp'
+  if header.startswith(b'GIF8'):
+    return 'gif'
+  content_type = (content_type or '').split(';')[0].strip().lower()
+  return IMAGE_CONTENT_TYPES.get(content_type, 'png')
+
+def page_file(path):
+  # downloaded page of the path without extension, None if not downloaded
+  for extension in PAGE_EXTENSIONS:
+    if os.path.isfile(f'{path}.{extension}'):
+      return f'{path}.{extension}'
+  return None
 
 def strip_path(path, keep):
   return ''.join(c for c in path if c.isalnum() or c in keep).strip()
 
-def encode_path(filename, extension, directory='.'):
-  return strip_path(f'{directory}/{filename}', DIRECTORY_KEEP) + '.' + strip_path(extension, EXTENSION_KEEP)
-
-def encode(title):
-  return re.sub(r'\W+', '-', title)
-
 def decode(title):
   return title.replace('-', ' ')
 
 def plural(size):
   return 's' if size != 1 else ''
 
-def download(filename, url, directory='.', extension='png', text='', ok=200):
-  path = encode_path(filename, extension, directory)
-  if os.path.isfile(path):
+METRICS_STAGES = {} # name: [calls, seconds]
+METRICS_COUNTERS = {}
+METRICS_LOCK = threading.Lock()
+METRICS_START = time.time()
+
+def count(name, value=1):
+  with METRICS_LOCK:
+    METRICS_COUNTERS[name] = METRICS_COUNTERS.get(name, 0) + value
+
+@contextmanager
+def stage(name):
+  # seconds are added up across threads, so concurrent stages may take longer than the run
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    with METRICS_LOCK:
+      calls, seconds = METRICS_STAGES.get(name, (0, 0))
+      METRICS_STAGES[name] = (calls + 1, seconds + elapsed)
+
+def metrics_report():
+  with METRICS_LOCK:
+    return {
+      'version': VERSION,
+      'start': METRICS_START,
+      'seconds': time.time() - METRICS_START,
+      'stages': { name: { 'calls': calls, 'seconds': seconds } for name, (calls, seconds) in METRICS_STAGES.items() },
+      'counters': dict(METRICS_COUNTERS, connections=connection_stats()[0])
+    }
+
+def prometheus_metrics(report):
+  # Prometheus textfile collector format
+  prefix = NAME.lower()
+  lines = [
+    f'# HELP {prefix}_run_seconds Wall time of the run.',
+    f'# TYPE {prefix}_run_seconds gauge',
+    f'{prefix}_run_seconds {report["seconds"]}',
+    f'# HELP {prefix}_stage_seconds Time spent in every stage, added up across workers.',
+    f'# TYPE {prefix}_stage_seconds gauge'
+  ]
+  lines += [f'{prefix}_stage_seconds{{stage="{name}"}} {stage["seconds"]}' for name, stage in sorted(report['stages'].items())]
+  lines += [f'# HELP {prefix}_stage_calls Number of times every stage was run.', f'# TYPE {prefix}_stage_calls gauge']
+  lines += [f'{prefix}_stage_calls{{stage="{name}"}} {stage["calls"]}' for name, stage in sorted(report['stages'].items())]
+  for name, value in sorted(report['counters'].items()):
+    lines += [f'# TYPE {prefix}_{name} gauge', f'{prefix}_{name} {value}']
+  return '\n'.join(lines) + '\n'
+
+def write_metrics():
+  # called at exit, also when cancelled
+  report = metrics_report()
+  if args.metrics.endswith('.prom'):
+    write_text(args.metrics, prometheus_metrics(report))
+  else:
+    write_json(args.metrics, report)
+
+HOST_SEMAPHORES = {}
+HOST_SEMAPHORES_LOCK = threading.Lock()
+
+def host_semaphore(url):
+  host = urlparse(url).netloc
+  with HOST_SEMAPHORES_LOCK:
+    if host not in HOST_SEMAPHORES:
+      HOST_SEMAPHORES[host] = threading.BoundedSemaphore(args.host_connections or args.workers)
+    return HOST_SEMAPHORES[host]
+
+def scraper():
+  # created when the first request is done
+  global SCRAPER
+  with SCRAPER_LOCK:
+    if SCRAPER is None:
+      import cloudscraper
+      SCRAPER = cloudscraper.create_scraper()
+      configure_pools(SCRAPER)
+      restore_session(SCRAPER)
+    return SCRAPER
+
+SESSION_TTL = 12 * 3600
+SESSION_REJECTED_STATUS = set([403, 503])
+RESTORED_SESSION = None
+SESSION_LOCK = threading.Lock()
+SESSION_MODE = 0o600 # cookies are readable only by the user
+
+def session_path():
+  return f'{CACHE_DIR}/session.json'
+
+def session_key():
+  return urlparse(PROVIDER_WEBSITE).netloc
+
+def restore_session(session):
+  # cookies (Cloudflare clearance) and user agent of the last run, so the challenge is not solved again
+  global RESTORED_SESSION
+  if args.refresh:
+    return
+  state = read_json(session_path(), {}).get(session_key())
+  if state is None or time.time() - state['time'] > SESSION_TTL:
+    return
+  session.headers['User-Agent'] = state['user_agent']
+  for cookie in state['cookies']:
+    if cookie['expires'] is None or cookie['expires'] > time.time():
+      session.cookies.set_cookie(requests.cookies.create_cookie(**cookie))
+  RESTORED_SESSION = session
+
+def save_session():
+  # other runs may save their sessions at the same time, the file is replaced atomically
+  if SCRAPER is None:
+    return
+  cookies = [{ 'name': cookie.name, 'value': cookie.value, 'domain': cookie.domain, 'path': cookie.path, 'expires': cookie.expires, 'secure': cookie.secure } for cookie in SCRAPER.cookies]
+  with SESSION_LOCK:
+    states = read_json(session_path(), {})
+    states[session_key()] = { 'time': time.time(), 'user_agent': SCRAPER.headers.get('User-Agent'), 'cookies': cookies }
+    try:
+      write_json(session_path(), states, SESSION_MODE)
+    except OSError:
+      pass
+
+def discard_session(session):
+  # the restored session was rejected, a new session solves the challenge again
+  global SCRAPER, RESTORED_SESSION
+  with SCRAPER_LOCK:
+    if SCRAPER is not session:
+      return # already discarded by another worker
+    print_dim('Saved session rejected, starting a new session', Fore.YELLOW)
+    SCRAPER = None
+    RESTORED_SESSION = None
+  with SESSION_LOCK:
+    states = read_json(session_path(), {})
+    if states.pop(session_key(), None) is not None:
+      try:
+        write_json(session_path(), states, SESSION_MODE)
+      except OSError:
+        pass
+
+# JSON and HTML are compressed, images are already compressed
+COMPRESSED_HEADERS = { 'Accept-Encoding': 'gzip, deflate' }
+IMAGE_HEADERS = { 'Accept-Encoding': 'identity' }
+
+def pool_size():
+  # enough connections for every worker, otherwise connections are closed and opened again
+  return args.pool_size or max(args.workers, args.host_connections or 0, 10)
+
+def configure_pools(session):
+  # the adapters of cloudscraper are kept (their TLS settings bypass Cloudflare), only their pools are resized
+  # TCP keep-alive, so idle pooled connections are not dropped silently
+  from urllib3.connection import HTTPConnection
+  import socket
+  socket_options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+  for adapter in set(session.adapters.values()):
+    adapter.poolmanager.clear()
+    adapter._pool_maxsize = pool_size()
+    adapter.init_poolmanager(adapter._pool_connections, adapter._pool_maxsize, block=adapter._pool_block, socket_options=socket_options)
+  session.headers['Connection'] = 'keep-alive'
+
+def connection_stats():
+  # connections opened and requests sent through the pools of the session
+  connections = pooled_requests = 0
+  if SCRAPER is not None:
+    for adapter in set(SCRAPER.adapters.values()):
+      pools = adapter.poolmanager.pools
+      for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+          connections += pool.num_connections
+          pooled_requests += pool.num_requests
+  return connections, pooled_requests
+
+def print_connection_stats():
+  connections, pooled_requests = connection_stats()
+  if pooled_requests:
+    reused = 100 * (pooled_requests - connections) // pooled_requests
+    print_dim(f'{pooled_requests} request{plural(pooled_requests)} through {connections} connection{plural(connections)} ({reused}% reused, pool size {pool_size()})')
+
+RETRY_STATUS = set([429, 500, 502, 503, 504])
+MAX_BACKOFF = 60
+
+NEXT_REQUEST_TIME = 0
+NEXT_REQUEST_LOCK = threading.Lock()
+
+def wait_turn():
+  # global budget of --rate-limit requests per second, shared by all workers
+  global NEXT_REQUEST_TIME
+  with NEXT_REQUEST_LOCK:
+    now = time.monotonic()
+    start = max(now, NEXT_REQUEST_TIME)
+    if args.rate_limit:
+      NEXT_REQUEST_TIME = start + 1 / args.rate_limit
+  if start > now:
+    time.sleep(start - now)
+
+def pause_requests(delay):
+  # every worker waits when the server asks to slow down
+  global NEXT_REQUEST_TIME
+  with NEXT_REQUEST_LOCK:
+    NEXT_REQUEST_TIME = max(NEXT_REQUEST_TIME, time.monotonic() + delay)
+
+def retry_after(response):
+  # seconds from the Retry-After header (delay or HTTP date) or None
+  value = response.headers.get('Retry-After') if response is not None else None
+  if not value:
+    return None
+  try:
+    return max(0, float(value))
+  except ValueError:
+    try:
+      return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+      return None
+
+def backoff(attempt):
+  # exponential backoff with full jitter
+  return random.uniform(0, min(MAX_BACKOFF, args.backoff * 2 ** attempt))
+
+def request(method, url, read=None, **kwargs):
+  # retries connection errors, timeouts and RETRY_STATUS responses, raises ConnectionError when retries are exhausted
+  # read(response) reads the body of streamed responses while the connection to the host is still counted
+  kwargs.setdefault('timeout', args.timeout)
+  for attempt in range(args.retries + 1):
+    last_attempt = attempt == args.retries
+    response = None
+    wait_turn()
+    count('requests')
+    if attempt > 0:
+      count('retries')
+    try:
+      session = scraper()
+      with host_semaphore(url):
+        response = session.request(method, url, **kwargs)
+        if read is not None:
+          read(response)
+      if not kwargs.get('stream'):
+        count('bytes', len(response.content))
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+      if last_attempt:
+        raise e if isinstance(e, requests.exceptions.ConnectionError) else requests.exceptions.ConnectionError(e)
+      reason = type(e).__name__
+    else:
+      if response.status_code in SESSION_REJECTED_STATUS and session is RESTORED_SESSION:
+        response.close()
+        discard_session(session)
+        return request(method, url, read, **kwargs)
+      if response.status_code not in RETRY_STATUS or last_attempt:
+        return response
+      response.close()
+      reason = response.status_code
+    server_delay = retry_after(response)
+    delay = min(server_delay, MAX_BACKOFF) if server_delay is not None else backoff(attempt)
+    print_dim(f'[{reason}] {url} - Retrying ({attempt + 1}/{args.retries}) after {delay:.1f}s', Fore.YELLOW)
+    if server_delay is not None:
+      pause_requests(delay) # every worker waits in wait_turn
+    else:
+      time.sleep(delay)
+
+def get(url, **kwargs):
+  return request('GET', url, **kwargs)
+
+def fetch(path, url, ok=200, native=False):
+  # (request, path), request is None if already downloaded
+  # with native, path has no extension and the one of the downloaded image is added
+  existing = page_file(path) if native else path if os.path.isfile(path) else None
+  if existing is not None:
+    return None, existing
+  # a connection lost while downloading the body is retried by request, with the same retries
+  written = []
+  def read(response):
+    if response.status_code == ok:
+      written.append(write_stream(path, response, native))
+  req = get(url, stream=True, headers=IMAGE_HEADERS, read=read)
+  req.close()
+  return req, written[0] if written else path
+
+def report(path, req, text='', ok=200):
+  if req is None:
     text = text if text else path
     separation = ' ' * (20 - len(text))
     print_colored(f'{text}{separation}- Already exists', Fore.YELLOW)
     return False
-  req = SCRAPER.get(url)
-  if success(req, text, ok, print_ok=bool(text)):
-    data = req.content
-    write_file(path, data)
-    return True
-  return False
+  return success(req, text, ok, print_ok=bool(text))
 
 def manga_directory(manga):
   return f'{MANGA_DIR}/{manga}'
@@ -240,26 +664,165 @@ def files(dir, extension=''):
     if os.path.isfile(path) and file.endswith(extension):
       yield filename(file), path
 
-def folders(dir):
-  if not os.path.isdir(dir):
-    error(f'{dir} does not exist');
-  for subdir in os.listdir(dir):
-    path = os.path.abspath(f'{dir}/{subdir}')
-    if os.path.isdir(path):
-      yield subdir, path
-
-def copy_all(name_path_list, to_path):
-  import errno, shutil
-  def copy(src, dest):
+def stage_file(src, dest):
+  # hardlink, symlink when src is in another filesystem, copy only if links are not supported (or --staging copy)
+  import shutil
+  if args.staging == 'link':
     try:
-      shutil.copytree(src, dest)
-    except OSError as e:
-      if e.errno == errno.ENOTDIR: # src is file
-        shutil.copy(src, dest)
-      else:
-        error(e)
+      os.link(src, dest)
+      return
+    except OSError:
+      pass
+    try:
+      os.symlink(os.path.abspath(src), dest)
+      return
+    except OSError:
+      pass
+  shutil.copy2(src, dest)
+
+def stage_all(name_path_list, to_path):
   for name, path in name_path_list:
-    copy(path, f'{to_path}/{name}')
+    dest = f'{to_path}/{name}'
+    try:
+      if os.path.isdir(path):
+        os.makedirs(dest)
+        for file in os.listdir(path):
+          if not file.startswith('.') and os.path.isfile(f'{path}/{file}'):
+            stage_file(f'{path}/{file}', f'{dest}/{file}')
+      else:
+        stage_file(path, dest)
+    except OSError as e:
+      error(e)
+
+def read_json(path, default=None):
+  try:
+    with open(path, encoding='utf-8') as handler:
+      return json.load(handler)
+  except (OSError, ValueError):
+    return default
+
+def write_text(path, text, mode=0o666):
+  write_file(path, text.encode('utf-8'), mode)
+
+def write_file(path, data, mode=0o666):
+  with atomic_file(path, mode) as handler:
+    handler.write(data)
+
+def write_json(path, data, mode=0o666):
+  write_text(path, json.dumps(data, ensure_ascii=False, separators=(',', ':')), mode)
+
+METADATA = None
+METADATA_LOCK = threading.Lock()
+
+def metadata_path():
+  return f'{MANGA_DIR}/.metadata.json'
+
+def load_metadata():
+  global METADATA
+  if METADATA is None:
+    METADATA = read_json(metadata_path(), {})
+  return METADATA
+
+def cached_metadata(section, key, ttl):
+  # None if not cached, expired or --refresh
+  if args.refresh:
+    return None
+  with METADATA_LOCK:
+    entry = load_metadata().get(section, {}).get(key)
+  if entry is None or time.time() - entry['time'] > ttl:
+    count('cache_misses')
+    return None
+  count('cache_hits')
+  return entry['value']
+
+def cache_metadata(section, key, value):
+  with METADATA_LOCK:
+    load_metadata().setdefault(section, {})[key] = { 'time': time.time(), 'value': value }
+
+def save_metadata():
+  with METADATA_LOCK:
+    if METADATA is not None:
+      write_json(metadata_path(), METADATA)
+
+LIBRARY = None
+LIBRARY_LOCK = threading.Lock()
+LIBRARY_CHANGES = {}
+
+def library_path():
+  return f'{MANGA_DIR}/.library.json'
+
+def index_chapter_directory(path):
+  # [[file, size]] of the pages sorted by page number
+  pages = []
+  for entry in os.scandir(path):
+    name, _, page_extension = entry.name.rpartition('.')
+    if name.isdigit() and page_extension in PAGE_EXTENSIONS and entry.is_file():
+      pages.append((int(name), entry.name, entry.stat().st_size))
+  return [[file, size] for _, file, size in sorted(pages)]
+
+def index_library():
+  # { manga: { chapter: [[file, size]] } } of all the downloaded chapters, walking the whole directory
+  print_dim(f'Indexing {MANGA_DIR}...')
+  library = {}
+  if os.path.isdir(MANGA_DIR):
+    for manga_entry in os.scandir(MANGA_DIR):
+      if manga_entry.name.startswith('.') or not manga_entry.is_dir():
+        continue
+      chapters = library[manga_entry.name] = {}
+      for chapter_entry in os.scandir(manga_entry.path):
+        if not chapter_entry.name.startswith('.') and chapter_entry.is_dir():
+          try:
+            float(chapter_entry.name)
+          except ValueError:
+            continue
+          chapters[chapter_entry.name] = index_chapter_directory(chapter_entry.path)
+  return library
+
+def load_library():
+  # the library is indexed the first time or with --reindex, then updated with every downloaded chapter
+  global LIBRARY
+  with LIBRARY_LOCK:
+    if LIBRARY is None:
+      library = None if args.reindex else read_json(library_path())
+      if library is None:
+        library = index_library()
+        write_json(library_path(), library)
+      LIBRARY = library
+    return LIBRARY
+
+def library_chapters(manga):
+  # { chapter: [[file, size]] } of the chapters indexed for this manga, [file, size, True] if the page was verified
+  return load_library().get(manga, {})
+
+def index_chapter(manga, chapter, manifest_pages):
+  pages = sorted(manifest_pages.items(), key=lambda page: int(page[0]))
+  library_chapter(manga, chapter, [[entry['file'], entry['size']] for _, entry in pages])
+
+def index_verified(manga, chapter, files):
+  # [file, size, True] for the verified pages of a chapter without manifest
+  pages = [[file, size, True] if file in files else [file, size] for file, size, *_ in library_chapters(manga)[f'{chapter:g}']]
+  library_chapter(manga, chapter, pages)
+
+def reindex_chapter(manga, chapter):
+  # pages of the chapter changed
+  library_chapter(manga, chapter, index_chapter_directory(chapter_directory(manga, chapter)))
+
+def library_chapter(manga, chapter, chapter_pages):
+  load_library()
+  with LIBRARY_LOCK:
+    LIBRARY.setdefault(manga, {})[f'{chapter:g}'] = chapter_pages
+    LIBRARY_CHANGES[(manga, f'{chapter:g}')] = chapter_pages
+
+def save_library():
+  # other runs may have indexed other chapters meanwhile, only the chapters changed by this run are written over them
+  with LIBRARY_LOCK:
+    if not LIBRARY_CHANGES:
+      return
+    library = read_json(library_path()) or LIBRARY
+    for (manga, chapter), chapter_pages in LIBRARY_CHANGES.items():
+      library.setdefault(manga, {})[chapter] = chapter_pages
+    write_json(library_path(), library)
+    LIBRARY_CHANGES.clear()
 
 def load_json(data, *keys):
   data = json.loads(data)
@@ -404,21 +967,249 @@ def split_rotate_2_pages(rotate):
 def single(single):
   return str(0 if single else 2)
 
-def removeAlpha(image_path):
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+JPEG_SIGNATURE = b'\xff\xd8'
+
+OPAQUE_IMAGES = None # path: [size, mtime], images checked with Wand without alpha channel
+OPAQUE_IMAGES_LOCK = threading.Lock()
+
+def opaque_images_path():
+  return f'{MANGA_DIR}/.opaque.json'
+
+def png_has_alpha(handler):
+  # alpha channel or transparency from the PNG chunks before the image data
+  while True:
+    header = handler.read(8)
+    if len(header) < 8:
+      return False
+    length, chunk_type = struct.unpack('>I4s', header)
+    if chunk_type == b'IHDR':
+      color_type = handler.read(length)[9]
+      if color_type in (4, 6): # grayscale or RGB with alpha
+        return True
+      handler.seek(4, os.SEEK_CUR)
+    elif chunk_type == b'tRNS':
+      return True
+    elif chunk_type == b'IDAT':
+      return False
+    else:
+      handler.seek(length + 4, os.SEEK_CUR)
+
+def has_alpha(image_path):
+  # PNG and JPEG are checked from their headers, other images with Wand and cached while they are not modified
+  global OPAQUE_IMAGES
+  with open(image_path, 'rb') as handler:
+    signature = handler.read(len(PNG_SIGNATURE))
+    if signature.startswith(JPEG_SIGNATURE):
+      return False
+    if signature == PNG_SIGNATURE:
+      return png_has_alpha(handler)
+  stat = os.stat(image_path)
+  key = os.path.abspath(image_path)
+  with OPAQUE_IMAGES_LOCK:
+    if OPAQUE_IMAGES is None:
+      OPAQUE_IMAGES = read_json(opaque_images_path(), {})
+    if OPAQUE_IMAGES.get(key) == [stat.st_size, stat.st_mtime]:
+      return False
+  import wand.image
+  with wand.image.Image(filename=image_path) as img:
+    alpha = bool(img.alpha_channel)
+  if not alpha:
+    with OPAQUE_IMAGES_LOCK:
+      OPAQUE_IMAGES[key] = [stat.st_size, stat.st_mtime]
+  return alpha
+
+def save_opaque_images():
+  with OPAQUE_IMAGES_LOCK:
+    if OPAQUE_IMAGES is not None:
+      write_json(opaque_images_path(), OPAQUE_IMAGES)
+
+def remove_alpha(image_path):
+  # image_path if it has no alpha channel, otherwise the image over a white background in memory, source is not modified
+  if not has_alpha(image_path):
+    return image_path
+  import wand.image
   with wand.image.Image(filename=image_path) as img:
-    if img.alpha_channel:
-      img.alpha_channel = 'remove'
-      img.background_color = wand.image.Color('white')    
-      img.save(filename=image_path)
+    img.background_color = wand.image.Color('white')
+    img.alpha_channel = 'remove'
+    return img.make_blob('png')
+
+def ordered_map(pool, function, items, window):
+  # like pool.map, but only window items are processed ahead of the consumer
+  pending = deque()
+  for item in items:
+    pending.append(pool.submit(function, item))
+    if len(pending) >= window:
+      yield pending.popleft().result()
+  while pending:
+    yield pending.popleft().result()
+
+def open_image(image):
+  # image path or bytes
+  return io.BytesIO(image) if isinstance(image, bytes) else open(image, 'rb')
+
+def read_chunks(image, ranges):
+  # chunks of the (offset, length) ranges of an image
+  with open_image(image) as handler:
+    for offset, length in ranges:
+      handler.seek(offset)
+      while length > 0:
+        chunk = handler.read(min(length, CHUNK_SIZE))
+        if not chunk:
+          raise ValueError('Unexpected end of image')
+        length -= len(chunk)
+        yield chunk
+
+def png_pdf_image(image, handler):
+  # compressed image data is embedded as is, None if the PNG needs to be decoded (alpha, interlaced or 16 bits)
+  width = height = palette = None
+  data_ranges = []
+  while True:
+    header = handler.read(8)
+    if len(header) < 8:
+      break
+    length, chunk_type = struct.unpack('>I4s', header)
+    if chunk_type == b'IHDR':
+      width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', handler.read(13))
+      if interlace or bit_depth > 8 or color_type not in (0, 2, 3):
+        return None
+      handler.seek(4, os.SEEK_CUR)
+    elif chunk_type == b'PLTE':
+      palette = handler.read(length)
+      handler.seek(4, os.SEEK_CUR)
+    elif chunk_type == b'tRNS':
+      return None
+    elif chunk_type == b'IDAT':
+      data_ranges.append((handler.tell(), length))
+      handler.seek(length + 4, os.SEEK_CUR)
+    elif chunk_type == b'IEND':
+      break
+    else:
+      handler.seek(length + 4, os.SEEK_CUR)
+  if width is None or not data_ranges:
+    return None
+  if color_type == 3:
+    colors = 1
+    color_space = f'[/Indexed/DeviceRGB {len(palette) // 3 - 1}<{palette.hex()}>]'
+  else:
+    colors = 3 if color_type == 2 else 1
+    color_space = '/DeviceRGB' if color_type == 2 else '/DeviceGray'
+  dictionary = f'/ColorSpace{color_space}/BitsPerComponent {bit_depth}/Filter/FlateDecode/DecodeParms<</Predictor 15/Colors {colors}/BitsPerComponent {bit_depth}/Columns {width}>>'
+  return width, height, dictionary, read_chunks(image, data_ranges)
+
+def jpeg_pdf_image(image, handler):
+  # the whole JPEG is embedded as is, None if CMYK
+  while True:
+    marker = handler.read(2)
+    if len(marker) < 2 or marker[0] != 0xff:
+      return None
+    if marker[1] in (0xd8, 0x01) or 0xd0 <= marker[1] <= 0xd7: # markers without length
+      continue
+    length = struct.unpack('>H', handler.read(2))[0]
+    if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc): # start of frame
+      _, height, width, components = struct.unpack('>BHHB', handler.read(6))
+      if components not in (1, 3):
+        return None
+      color_space = '/DeviceRGB' if components == 3 else '/DeviceGray'
+      size = handler.seek(0, os.SEEK_END)
+      return width, height, f'/ColorSpace{color_space}/BitsPerComponent 8/Filter/DCTDecode', read_chunks(image, [(0, size)])
+    handler.seek(length - 2, os.SEEK_CUR)
+
+def decoded_pdf_image(image):
+  # other images are decoded with Pillow (img2pdf dependency) and compressed
+  from PIL import Image
+  with open_image(image) as handler, Image.open(handler) as img:
+    if img.mode in ('I', 'I;16', 'I;16B', 'I;16L'):
+      # 16-bit gray is scaled down to 8 bits instead of clamped
+      img = img.convert('I').point(lambda value: value / 256).convert('L')
+    gray = img.mode in ('1', 'L', 'LA')
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+      # transparent areas are white, not black
+      img = Image.alpha_composite(Image.new('RGBA', img.size, 'white'), img.convert('RGBA'))
+    img = img.convert('L' if gray else 'RGB')
+    color_space = '/DeviceGray' if img.mode == 'L' else '/DeviceRGB'
+    data = zlib.compress(img.tobytes())
+    return img.width, img.height, f'/ColorSpace{color_space}/BitsPerComponent 8/Filter/FlateDecode', [data]
+
+def pdf_image(image):
+  # (width, height, image dictionary entries, data chunks)
+  with open_image(image) as handler:
+    signature = handler.read(len(PNG_SIGNATURE))
+    handler.seek(0)
+    pdf_image = None
+    if signature == PNG_SIGNATURE:
+      handler.seek(len(PNG_SIGNATURE))
+      pdf_image = png_pdf_image(image, handler)
+    elif signature.startswith(JPEG_SIGNATURE):
+      pdf_image = jpeg_pdf_image(image, handler)
+  return pdf_image or decoded_pdf_image(image)
+
+def write_pdf(path, images):
+  # streaming PDF writer, only one page is in memory at a time
+  # images are pages at 96 dpi, like img2pdf
+  offsets = {}
+  last_id = 2 # 1: catalog, 2: pages
+  def new_id():
+    nonlocal last_id
+    last_id += 1
+    return last_id
+  def begin_object(object_id):
+    offsets[object_id] = handler.tell()
+    handler.write(f'{object_id} 0 obj\n'.encode())
+  def write_object(object_id, value):
+    begin_object(object_id)
+    handler.write(f'{value}\nendobj\n'.encode())
+  def write_stream(object_id, dictionary, chunks):
+    # length is written later as another object, so the stream is not kept in memory
+    length_id = new_id()
+    begin_object(object_id)
+    handler.write(f'<<{dictionary}/Length {length_id} 0 R>>\nstream\n'.encode())
+    start = handler.tell()
+    for chunk in chunks:
+      handler.write(chunk)
+    length = handler.tell() - start
+    handler.write(b'\nendstream\nendobj\n')
+    write_object(length_id, length)
+  pages = []
+  with atomic_file(path) as handler:
+    handler.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    for image in images:
+      width, height, dictionary, chunks = pdf_image(image)
+      page_id, image_id, content_id = new_id(), new_id(), new_id()
+      write_stream(image_id, f'/Type/XObject/Subtype/Image/Width {width}/Height {height}{dictionary}', chunks)
+      page_width, page_height = width * 72 / 96, height * 72 / 96
+      write_stream(content_id, '', [f'q {page_width:.4f} 0 0 {page_height:.4f} 0 0 cm /Im0 Do Q'.encode()])
+      write_object(page_id, f'<</Type/Page/Parent 2 0 R/MediaBox[0 0 {page_width:.4f} {page_height:.4f}]/Resources<</XObject<</Im0 {image_id} 0 R>>>>/Contents {content_id} 0 R>>')
+      pages.append(page_id)
+    write_object(2, f'<</Type/Pages/Kids[{" ".join(f"{page_id} 0 R" for page_id in pages)}]/Count {len(pages)}>>')
+    write_object(1, '<</Type/Catalog/Pages 2 0 R>>')
+    xref = handler.tell()
+    handler.write(f'xref\n0 {last_id + 1}\n0000000000 65535 f \n'.encode())
+    for object_id in range(1, last_id + 1):
+      handler.write(f'{offsets[object_id]:010d} 00000 n \n'.encode())
+    handler.write(f'trailer\n<</Size {last_id + 1}/Root 1 0 R>>\nstartxref\n{xref}\n%%EOF\n'.encode())
 
 def convert_to_pdf(path, chapters_paths):
   if not check_exists_file(path):
+    workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      images = chapters_paths
+      if args.remove_alpha:
+        print_dim(f'Removing alpha channel from images for {path}')
+        # Wand releases the GIL, only a few images are processed ahead so flattened images are not all in memory
+        images = ordered_map(pool, remove_alpha, chapters_paths, 2 * workers)
+      if args.stream_pdf:
+        with stage('write_pdf'):
+          write_pdf(path, images)
+      else:
+        import img2pdf
+        if args.remove_alpha:
+          with stage('remove_alpha'):
+            images = list(images)
+        with stage('img2pdf'), open(path, "wb") as f:
+          f.write(img2pdf.convert(images))
     if args.remove_alpha:
-      print_dim(f'Removing alpha channel from images for {path}')
-      for img_path in chapters_paths:
-        removeAlpha(img_path)
-    with open(path, "wb") as f:
-      f.write(img2pdf.convert(chapters_paths))
+      save_opaque_images()
     print_colored(f'DONE: {os.path.abspath(path)}', Fore.GREEN, Style.BRIGHT)
 
 def fix_corrupted_file(corrupted_file, corrupted_file_path, argv):
@@ -448,17 +1239,604 @@ def convert_except(e, argv):
     traceback.print_tb(e.__traceback__)
     error(e)
 
+KCC_WORKERS = None # set only in the processes of the conversion jobs
+
+def limited_pool(workers):
+  def pool(processes=None, *params, **kwargs):
+    return multiprocessing.Pool(min(processes or workers, workers), *params, **kwargs)
+  return pool
+
 def cache_convert(argv):
+  from kindlecomicconverter import comic2ebook
+  if KCC_WORKERS is not None and hasattr(comic2ebook, 'Pool'):
+    comic2ebook.Pool = limited_pool(KCC_WORKERS)
   try:
-    manga2ebook(argv)
+    with stage('kcc'):
+      comic2ebook.main(argv)
   except Exception as e:
     convert_except(e, argv)
 
-def online_search():
+PROCESSED_DIR = f'{CACHE_DIR}/processed'
+PROCESSED_IN_USE = 600 # seconds
+PROCESSED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp')
+
+def kcc_option(argv, option, value):
+  # argv with the value of the option replaced
+  argv = list(argv)
+  argv[argv.index(option) + 1] = value
+  return argv
+
+def processed_key(chapter):
+  # KCC version, image processing options and the hash of every page of the chapter
+  import kindlecomicconverter
+  manifest = read_json(manifest_path(manga, chapter))
+  if manifest is not None:
+    hashes = [page['sha1'] for _, page in sorted(manifest['pages'].items(), key=lambda page: int(page[0]))]
+  else:
+    hashes = [file_entry(path)['sha1'] for path in chapter_pages_paths(chapter)]
+  options = [getattr(kindlecomicconverter, '__version__', ''), args.profile, split_rotate_2_pages(args.rotate), str(args.fullsize)]
+  return hashlib.sha1(' '.join(options + hashes).encode()).hexdigest()
+
+def processed_chapter(chapter, argv):
+  # directory with the pages of the chapter processed by KCC for the profile, reused by other formats and --single
+  # pages are processed once with a CBZ conversion, then the requested format is built without processing (-n)
+  import shutil
+  import zipfile
+  path = f'{PROCESSED_DIR}/{processed_key(chapter)}'
+  if os.path.isdir(path):
+    count('processed_cache_hits')
+    os.utime(path) # least recently used are evicted first
+    return path
+  count('processed_cache_misses')
+  os.makedirs(PROCESSED_DIR, exist_ok=True)
+  with tempfile.TemporaryDirectory(dir=PROCESSED_DIR, prefix='.') as temp:
+    source = chapter_directory(manga, chapter)
+    cache_convert(kcc_option(kcc_option(argv, '--output', temp), '-f', 'CBZ') + ['--title', f'{manga_title} {chapter:g}', source])
+    os.makedirs(f'{temp}/pages')
+    with zipfile.ZipFile(f'{temp}/{os.path.basename(source)}.cbz') as cbz:
+      # flattened in name order, the order of CBZ readers, as KCC does not write entries sorted
+      images = sorted(name for name in cbz.namelist() if name.lower().endswith(PROCESSED_EXTENSIONS))
+      for number, name in enumerate(images, start=1):
+        with cbz.open(name) as image, open(f'{temp}/pages/{number:05d}{os.path.splitext(name)[1].lower()}', 'wb') as handler:
+          shutil.copyfileobj(image, handler)
+    try:
+      os.rename(f'{temp}/pages', path)
+    except OSError:
+      # processed meanwhile by another conversion
+      if not os.path.isdir(path):
+        raise
+  evict_processed()
+  return path
+
+def evict_processed():
+  # least recently used chapters are removed while the cache is bigger than --processed-cache
+  # chapters used in the last minutes are kept, other conversions may be using them
+  import shutil
+  entries = []
+  for entry in os.scandir(PROCESSED_DIR):
+    if not entry.name.startswith('.') and entry.is_dir():
+      size = sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(entry.path) for file in files)
+      entries.append((entry.stat().st_mtime, size, entry.path))
+  total = sum(size for _, size, _ in entries)
+  for mtime, size, path in sorted(entries):
+    if total <= args.processed_cache * 2**20 or time.time() - mtime < PROCESSED_IN_USE:
+      break
+    shutil.rmtree(path, ignore_errors=True)
+    total -= size
+
+JOB_GLOBALS = ['args', 'MANGA_DIR', 'directory', 'manga', 'manga_title']
+
+def run_job(context, target, *params):
+  # globals and console colors are set in __main__, which is not executed by spawned processes
+  globals().update(context)
+  init_console_colors()
+  target(*params)
+
+def run_process(target, *params):
+  # non-daemonic process, so KCC is allowed to start its own workers
+  # spawned, as forking while the download threads hold locks may leave them locked in the child
+  context = { name: globals()[name] for name in JOB_GLOBALS if name in globals() }
+  process = multiprocessing.get_context('spawn').Process(target=run_job, args=(context, target) + params)
+  process.start()
+  process.join()
+  return process.exitcode
+
+def output_path(name, extension):
+  return f'{MANGA_DIR}/{manga_title} {name}{extension}'
+
+def chapter_pages_paths(chapter):
+  if args.cache:
+    # pages removed without this script are skipped, verify_chapters indexes the chapter again
+    chapter_dir = chapter_directory(manga, chapter)
+    paths = [os.path.abspath(f'{chapter_dir}/{file}') for file, *_ in library_chapters(manga)[f'{chapter:g}']]
+    return [path for path in paths if os.path.isfile(path)]
+  page_number_paths = sorted(files(chapter_directory(manga, chapter), tuple(f'.{extension}' for extension in PAGE_EXTENSIONS)), key=lambda page_path: int(page_path[0]))
+  return [page_path for _, page_path in page_number_paths]
+
+def convert_chapter_to_pdf(chapter, extension):
+  convert_to_pdf(output_path(f'{chapter:g}', extension), chapter_pages_paths(chapter))
+
+def convert_chapter_to_cbz(chapter, extension):
+  convert_to_cbz(output_path(f'{chapter:g}', extension), f'{manga_title} {chapter:g}', chapter_pages_paths(chapter))
+
+def comic_info(title):
+  # ComicInfo.xml, read by most CBZ readers
+  title = html.escape(title)
+  series = html.escape(manga_title)
+  return f'<?xml version="1.0" encoding="utf-8"?>\n<ComicInfo><Title>{title}</Title><Series>{series}</Series><Manga>YesAndRightToLeft</Manga></ComicInfo>\n'
+
+def convert_to_cbz(path, title, pages_paths):
+  # pages are stored without compression in page order, like they were downloaded, without KCC
+  import zipfile
+  if not check_exists_file(path):
+    with stage('write_cbz'), atomic_file(path) as handler, zipfile.ZipFile(handler, 'w', zipfile.ZIP_STORED) as cbz:
+      for number, page_path in enumerate(pages_paths, start=1):
+        cbz.write(page_path, f'{number:05d}{os.path.splitext(page_path)[1]}')
+      cbz.writestr('ComicInfo.xml', comic_info(title))
+    print_colored(f'DONE: {os.path.abspath(path)}', Fore.GREEN, Style.BRIGHT)
+
+def convert_chapter_to_ebook(chapter, extension, argv):
+  title = f'{manga_title} {chapter:g}'
+  print_colored(title, Fore.BLUE)
+  source = chapter_directory(manga, chapter)
+  if args.processed_cache:
+    source = processed_chapter(chapter, argv)
+    argv = argv + ['-n']
+  cache_convert(argv + ['--title', title, source])
+  path = output_path(f'{chapter:g}', extension)
+  os.rename(f'{MANGA_DIR}/{os.path.basename(source)}{extension}', path)
+  print_colored(f'DONE: {os.path.abspath(path)}', Fore.GREEN, Style.BRIGHT)
+
+def convert_job(convert_chapter, chapter, extension, *params):
+  # share the cores between conversion jobs, every KCC conversion uses its own pool of workers
+  global KCC_WORKERS
+  KCC_WORKERS = max(1, (os.cpu_count() or 1) // args.convert_jobs)
+  convert_chapter(chapter, extension, *params)
+
+def convert_chapters(convert_chapter, chapters, extension, *params):
+  # chapters may be still downloading (--pipeline), every chapter is converted as soon as it is yielded
+  def convert_process(chapter):
+    with stage('convert_process'):
+      return run_process(convert_job, convert_chapter, chapter, extension, *params)
+  if args.convert_jobs == 1 and not args.pipeline:
+    for chapter in chapters:
+      convert_chapter(chapter, extension, *params)
+  else:
+    converted = []
+    jobs = []
+    try:
+      for chapter in chapters:
+        converted.append(chapter)
+        jobs.append(convert_pool().submit(convert_process, chapter))
+    finally:
+      concurrent.futures.wait(jobs)
+    # a failed job may leave the file of a previous conversion
+    failed = [chapter for chapter, job in zip(converted, jobs) if job.exception() is not None or job.result() != 0 or not os.path.isfile(output_path(f'{chapter:g}', extension))]
+    if failed:
+      error(f'The following chapters could not be converted: {chapters_to_intervals_string(failed, interval_sep=", ")}')
+
+PAGE_LIST_PATTERN = re.compile(rb'<select[^>]*\bid=["\']?PageList\b[^>]*>(.*?)</select>', re.S | re.I)
+PAGE_OPTION_PATTERN = re.compile(rb'<option[^>]*\bvalue=["\']([^"\']*)["\'][^>]*>\s*(\d+)\s*</option>', re.S | re.I)
+SEARCH_RESULT_PATTERN = re.compile(r'<a\b[^>]*\bhref=["\']([^"\']*)["\'][^>]*>.*?<h4[^>]*>(.*?)</h4>.*?</a>', re.S | re.I)
+TAG_PATTERN = re.compile(r'<[^>]*>')
+
+def parse_page_list_soup(content):
+  from bs4 import BeautifulSoup
+  soup = BeautifulSoup(content, 'html.parser')
+  return [(int(page.get_text()), page.get('value')) for page in soup.find(id='PageList').find_all(True, recursive=False)]
+
+def parse_page_list(content):
+  # [(page_number, page_id)] from the PageList options of the chapter HTML
+  # only the PageList select is matched, BeautifulSoup is used if the markup is not the expected one
+  page_list = PAGE_LIST_PATTERN.search(content)
+  if page_list:
+    options = PAGE_OPTION_PATTERN.findall(page_list.group(1))
+    if options and len(options) == page_list.group(1).lower().count(b'<option'):
+      return [(int(page_number), page_id.decode('utf-8')) for page_id, page_number in options]
+  return parse_page_list_soup(content)
+
+def parse_search_soup(text):
+  from bs4 import BeautifulSoup
+  results = BeautifulSoup(text, 'html.parser').find_all("a", href=True, recursive=False)
+  return [(result.get('href'), result.find('h4').get_text().strip()) for result in results]
+
+def parse_search(text):
+  # [(href, title)] of the search results, BeautifulSoup is used if the markup is not the expected one
+  results = SEARCH_RESULT_PATTERN.findall(text)
+  if results and len(results) == text.lower().count('<h4'):
+    return [(href, html.unescape(TAG_PATTERN.sub('', title)).strip()) for href, title in results]
+  return parse_search_soup(text)
+
+def chapter_page_list(chapter):
+  # [(page_number, page_id)] and the index request, which is None if the page list was cached
+  chapter_id = CHAPTERS_IDS[chapter]
+  page_list = cached_metadata('pages', chapter_id, PAGES_CACHE_TTL)
+  if page_list is not None:
+    return None, page_list
+  with stage('page_list'):
+    index = get(CHAPTER_PAGES_WEBSITE + chapter_id, headers=COMPRESSED_HEADERS)
+  page_list = []
+  if index.status_code == 200:
+    with stage('parse_page_list'):
+      page_list = parse_page_list(index.content)
+    cache_metadata('pages', chapter_id, page_list)
+  return index, page_list
+
+def manifest_path(manga, chapter):
+  return f'{chapter_directory(manga, chapter)}/.manifest.json'
+
+def file_entry(path):
+  sha1 = hashlib.sha1()
+  size = 0
+  with open(path, 'rb') as handler:
+    for chunk in iter(lambda: handler.read(CHUNK_SIZE), b''):
+      sha1.update(chunk)
+      size += len(chunk)
+  return { 'file': os.path.basename(path), 'size': size, 'sha1': sha1.hexdigest() }
+
+JPEG_END = b'\xff\xd9'
+
+def page_is_valid(path):
+  # PNG chunks are checked with their CRC, JPEG must be complete, other images are decoded
+  from PIL import Image
+  try:
+    with Image.open(path) as img:
+      if img.format == 'PNG':
+        img.verify()
+      elif img.format == 'JPEG':
+        with open(path, 'rb') as handler:
+          handler.seek(max(0, os.path.getsize(path) - 1024))
+          if JPEG_END not in handler.read():
+            return False
+      else:
+        img.load()
+    return True
+  except Exception:
+    return False
+
+def verify_chapters(chapters):
+  # all the pages not verified yet are checked in parallel before converting, instead of failing the conversion
+  # corrupted pages are downloaded again in one batch, or removed with --cache like KCC did before
+  # verified pages are recorded in the chapter manifest, or in the library for chapters without manifest
+  # so they are not checked again
+  manifests = {}
+  verified = {} # chapter: files verified of the chapters without manifest
+  missing = set() # chapters indexed with pages that do not exist anymore
+  checks = []
+  with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+    for chapter in chapters:
+      manifest = manifests[chapter] = read_json(manifest_path(manga, chapter))
+      paths = chapter_pages_paths(chapter)
+      if args.cache and len(paths) != len(library_chapters(manga)[f'{chapter:g}']):
+        # incomplete, the manifest is removed
+        print_dim(f'Pages of chapter {chapter:g} were removed, indexing it again', Fore.YELLOW)
+        missing.add(chapter)
+        manifest = manifests[chapter] = None
+      entries = { page['file']: page for page in manifest['pages'].values() } if manifest is not None else {}
+      indexed = { page[0]: page for page in library_chapters(manga).get(f'{chapter:g}', []) } if manifest is None else {}
+      verified[chapter] = set()
+      for path in paths:
+        file = os.path.basename(path)
+        entry = entries.get(file)
+        if entry is not None and entry.get('verified') and os.path.getsize(path) == entry['size']:
+          continue
+        page = indexed.get(file)
+        if page is not None and len(page) > 2 and page[2] and os.path.getsize(path) == page[1]:
+          verified[chapter].add(file)
+          continue
+        checks.append((chapter, path, entry, pool.submit(page_is_valid, path)))
+  corrupted = []
+  for chapter, path, entry, valid in checks:
+    count('pages_verified')
+    if valid.result():
+      if entry is not None:
+        entry['verified'] = True
+      else:
+        verified[chapter].add(os.path.basename(path))
+    else:
+      count('pages_corrupted')
+      print_colored(f'{path} is corrupted', Fore.RED)
+      if os.path.isfile(path):
+        os.remove(path)
+      corrupted.append((chapter, path))
+  if corrupted and not args.cache:
+    redownload_pages(corrupted, manifests)
+  elif corrupted:
+    print_dim('Corrupted pages are removed, download them again without --cache')
+    for chapter, _ in corrupted:
+      manifests[chapter] = None
+  for chapter in set(chapter for chapter, _, _, _ in checks) | missing:
+    if manifests[chapter] is not None:
+      write_json(manifest_path(manga, chapter), manifests[chapter])
+    elif os.path.isfile(manifest_path(manga, chapter)):
+      # incomplete, so missing pages are downloaded next time
+      os.remove(manifest_path(manga, chapter))
+  for chapter in set(chapter for chapter, _ in corrupted) | missing:
+    reindex_chapter(manga, chapter)
+  for chapter in set(chapter for chapter, _, _, _ in checks) | missing:
+    if manifests[chapter] is None and f'{chapter:g}' in library_chapters(manga):
+      index_verified(manga, chapter, verified[chapter])
+
+def redownload_pages(pages, manifests):
+  # [(chapter, path)] pages are requested again at the same time
+  downloads = []
+  for chapter, path in pages:
+    page_ids = dict(chapter_page_list(chapter)[1])
+    page_number = int(os.path.basename(path).split('.')[0])
+    base = path[:-len(os.path.splitext(path)[1])]
+    # not in the page list if it could not be requested
+    page_id = page_ids.get(page_number)
+    download = download_pool().submit(download_page, base, IMAGE_WEBSITE + page_id) if page_id is not None else None
+    downloads.append((chapter, page_number, download))
+  for chapter, page_number, download in downloads:
+    req, entry = download.result() if download is not None else (None, None)
+    if entry is not None and page_is_valid(os.path.join(chapter_directory(manga, chapter), entry['file'])):
+      print_colored(f'{entry["file"]} of chapter {chapter:g} downloaded again', Fore.GREEN)
+      entry['verified'] = True
+    else:
+      print_colored(f'Page {page_number} of chapter {chapter:g} could not be downloaded again', Fore.RED)
+      if entry is not None:
+        os.remove(os.path.join(chapter_directory(manga, chapter), entry['file']))
+      entry = None
+    if manifests[chapter] is not None:
+      if entry is not None:
+        manifests[chapter]['pages'][str(page_number)] = entry
+      else:
+        manifests[chapter] = None
+  save_metadata()
+
+def verified_chapters(chapters):
+  # --pipeline, every chapter is verified once downloaded, the library is saved once all are verified
+  try:
+    for chapter in chapters:
+      verify_chapters([chapter])
+      yield chapter
+  finally:
+    save_library()
+
+def damaged_pages(manga, chapter, manifest):
+  # page files missing or different from the manifest
+  chapter_dir = chapter_directory(manga, chapter)
+  for page in manifest['pages'].values():
+    path = f'{chapter_dir}/{page["file"]}'
+    if not os.path.isfile(path) or os.path.getsize(path) != page['size'] or file_entry(path)['sha1'] != page['sha1']:
+      yield path
+
+def download_page(path, url):
+  # path has no extension, pages are saved in the format sent by the server
+  with stage('download_page'):
+    req, path = fetch(path, url, native=True)
+  if req is None:
+    count('pages_existing')
+  elif req.status_code == 200:
+    count('pages_downloaded')
+    if args.prescale:
+      with stage('prescale'):
+        if prescale_pool().submit(prescale_page, path, profile_size(), args.rotate).result():
+          count('pages_prescaled')
+  else:
+    count('pages_failed')
+  entry = file_entry(path) if os.path.isfile(path) else None
+  if entry is not None and args.dedup:
+    store_blob(path, entry['sha1'])
+  return req, entry
+
+def profile_size():
+  # (width, height) of the --profile device screen
+  from kindlecomicconverter.image import ProfileData
+  if args.profile not in ProfileData.Profiles:
+    error(f'Unknown profile {args.profile}')
+  return ProfileData.Profiles[args.profile][1]
+
+def prescale_page(path, size, rotate):
+  # the page is reduced to fit the device screen, double pages to fit 2 screens (split) or the rotated screen
+  # pages are never enlarged, KCC still does the final processing
+  # returns True if the page was reduced
+  from PIL import Image
+  with Image.open(path) as img:
+    width, height = size
+    if img.width > img.height:
+      width, height = (height, width) if rotate else (2 * width, height)
+    scale = min(width / img.width, height / img.height)
+    if scale >= 1:
+      return False
+    image_format = img.format
+    palette = img.mode == 'P'
+    if palette:
+      # palette images are only resized with nearest neighbour, gray palettes are resized as grayscale
+      # and other opaque palettes in RGB quantized back to a palette, so pages do not grow or gain an alpha channel
+      colors = img.getpalette() or []
+      gray = all(colors[i] == colors[i + 1] == colors[i + 2] for i in range(0, len(colors) - 2, 3))
+      img = img.convert('RGBA' if 'transparency' in img.info else 'L' if gray else 'RGB')
+    elif img.mode == '1':
+      img = img.convert('L')
+    img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+    if palette and img.mode == 'RGB':
+      img = img.quantize(256)
+  data = io.BytesIO()
+  img.save(data, image_format, **({ 'quality': 90 } if image_format == 'JPEG' else {}))
+  write_file(path, data.getvalue())
+  return True
+
+def blobs_directory():
+  return f'{MANGA_DIR}/.blobs'
+
+def link_file(src, dest):
+  # dest is replaced atomically by a hardlink to src
+  link = f'{os.path.dirname(dest)}/.{os.path.basename(dest)}.link'
+  if os.path.exists(link):
+    os.remove(link)
+  os.link(src, link)
+  os.replace(link, dest)
+
+def store_blob(path, sha1):
+  # pages with the same content are hardlinks to the same file of the store, named by its hash
+  # nothing is done if the file system does not support hardlinks
+  blob = f'{blobs_directory()}/{sha1[:2]}/{sha1}'
+  try:
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    try:
+      os.link(path, blob)
+    except FileExistsError:
+      if os.path.samefile(path, blob):
+        return
+      if file_entry(blob)['sha1'] != sha1:
+        # the stored page was damaged on disk, the fresh page replaces it
+        link_file(path, blob)
+      else:
+        link_file(blob, path)
+        count('pages_deduplicated')
+  except OSError as e:
+    print_dim(f'{path} cannot be deduplicated: {e}', Fore.YELLOW)
+
+def collect_garbage():
+  # pages of the store not linked by any chapter are removed
+  removed = freed = 0
+  if os.path.isdir(blobs_directory()):
+    for prefix in os.scandir(blobs_directory()):
+      if not prefix.is_dir():
+        continue
+      for blob in os.scandir(prefix.path):
+        blob_stat = blob.stat()
+        if blob_stat.st_nlink == 1:
+          os.remove(blob.path)
+          removed += 1
+          freed += blob_stat.st_size
+  print_colored(f'Removed {removed} unused page{plural(removed)} from {blobs_directory()} ({freed / 2**20:.1f} MB)', Fore.GREEN)
+
+def submit_chapter(pool, manga, chapter):
+  # page list is retrieved now, pages are downloaded by the pool workers
+  # pages is None if the chapter manifest tells the chapter is complete
+  manifest = read_json(manifest_path(manga, chapter))
+  if manifest is not None:
+    damaged = list(damaged_pages(manga, chapter, manifest)) if args.verify else []
+    if not damaged:
+      count('chapters_skipped')
+      return chapter, None, None
+    for path in damaged:
+      print_dim(f'{path} is damaged or missing, downloading again')
+      if os.path.isfile(path):
+        os.remove(path)
+  index, page_list = chapter_page_list(chapter)
+  chapter_dir = chapter_directory(manga, chapter)
+  pages = []
+  for page_number, page_id in page_list:
+    path = strip_path(f'{chapter_dir}/{page_number}', DIRECTORY_KEEP)
+    text = f'Page {page_number}/{len(page_list)} ({100*page_number//len(page_list)}%)'
+    pages.append((page_number, path, text, pool.submit(download_page, path, IMAGE_WEBSITE + page_id)))
+  return chapter, index, pages
+
+def report_chapter(chapter, index, pages):
+  # print progress in page order, waiting for each page to be downloaded
+  # the chapter manifest is written once all pages are downloaded
+  print_colored(f'Downloading {manga_title} {chapter:g}', Fore.YELLOW, Style.BRIGHT)
+  if pages is None:
+    print_colored('Already downloaded', Fore.YELLOW)
+    if f'{chapter:g}' not in library_chapters(manga):
+      index_chapter(manga, chapter, read_json(manifest_path(manga, chapter))['pages'])
+    return True
+  complete = index is None or success(index, print_ok=False)
+  if complete:
+    manifest_pages = {}
+    for page_number, path, text, page in pages:
+      req, entry = page.result()
+      report(path, req, text)
+      complete = complete and entry is not None and (req is None or req.status_code == 200)
+      manifest_pages[str(page_number)] = entry
+    if complete and pages:
+      write_json(manifest_path(manga, chapter), { 'count': len(pages), 'pages': manifest_pages })
+      index_chapter(manga, chapter, manifest_pages)
+  return complete
+
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+def shared_pool(name, workers):
+  # created once, so batch jobs share the same workers
+  with POOLS_LOCK:
+    if name not in POOLS:
+      POOLS[name] = ThreadPoolExecutor(max_workers=workers)
+    return POOLS[name]
+
+def prescale_pool():
+  # image processing is CPU bound, so it is done in other processes
+  with POOLS_LOCK:
+    if 'prescale' not in POOLS:
+      from concurrent.futures import ProcessPoolExecutor
+      POOLS['prescale'] = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+    return POOLS['prescale']
+
+def download_pool():
+  return shared_pool('download', args.workers)
+
+def convert_pool():
+  return shared_pool('convert', args.convert_jobs)
+
+def download_chapters(manga, chapters, completed):
+  # yields every chapter once downloaded, chapters with all their pages downloaded are appended to completed
+  pool = download_pool()
+  queued = deque()
+  def report_next():
+    chapter = queued[0][0]
+    if report_chapter(*queued.popleft()):
+      completed.append(chapter)
+    return chapter
+  try:
+    for chapter in chapters:
+      queued.append(submit_chapter(pool, manga, chapter))
+      if len(queued) >= args.chapter_workers:
+        yield report_next()
+    while queued:
+      yield report_next()
+  except BaseException:
+    # cancel pending pages (Ctrl+C or network error) instead of waiting for them
+    for _, _, pages in queued:
+      for _, _, _, page in pages or []:
+        page.cancel()
+    raise
+  finally:
+    save_metadata()
+    save_library()
+
+def online_chapters(manga_uuid):
+  # [(chapter_number, chapter_id)], always requested so new chapters are found
+  try:
+    with stage('chapter_list'):
+      chapters_json = get(CHAPTERS_WEBSITE + manga_uuid, headers=COMPRESSED_HEADERS)
+    exit_if_fails(chapters_json)
+  except requests.exceptions.ConnectionError:
+    network_error()
+  chapters_full = load_json(chapters_json.content, 'data', 'result')
+  return [(chapter['Number'], chapter['Identification']) for chapter in chapters_full]
+
+def sync_path():
+  return f'{MANGA_DIR}/.sync.json'
+
+def synced_chapter(manga):
+  # last chapter completed by --sync or None if never synced
+  return read_json(sync_path(), {}).get(manga, {}).get('last')
+
+def save_synced_chapter(manga, manga_title, manga_uuid, last):
+  synced = read_json(sync_path(), {})
+  synced[manga] = { 'title': manga_title, 'uuid': manga_uuid, 'last': last, 'time': time.time() }
+  write_json(sync_path(), synced)
+
+def last_completed(chapters, completed):
+  # last chapter of the sorted chapters such that all previous chapters are completed
+  completed = set(completed)
+  last = None
+  for chapter in chapters:
+    if chapter not in completed:
+      break
+    last = chapter
+  return last
+
+def online_search(query):
+  # [(href, title)] of the provider search, href has the directory name of the manga
 
   data = {
     'hfilter[generes][]': '-1',
-    'filter[queryString]': MANGA,
+    'filter[queryString]': query,
     'filter[skip]': '0',
     'filter[take]': '10',
     'filter[sortby]': '1',
@@ -467,42 +1845,144 @@ def online_search():
   }
 
   headers = {
-    'Origin': 'https://inmanga.com',
+    'Origin': PROVIDER_WEBSITE,
     'Accept-Encoding': 'gzip, deflate',
     'Accept-Language': 'en-US,en;q=0.8',
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36',
     'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
     'Accept': '*/*',
-    'Referer': 'https://inmanga.com/manga/consult?suggestion=' + MANGA,
+    'Referer': f'{PROVIDER_WEBSITE}/manga/consult?suggestion=' + query,
     'X-Requested-With': 'XMLHttpRequest'
   }
 
-  try:
-    # Alternative Search: https://inmanga.com/OnMangaQuickSearch/Source/QSMangaList.json
-    search = SCRAPER.post(SEARCH_URL, data=data, headers=headers)
-    exit_if_fails(search)
-  except requests.exceptions.ConnectionError:
-    network_error()
-
-  return BeautifulSoup(search.content, 'html.parser').find_all("a", href=True, recursive=False)
-
-if __name__ == "__main__":
+  search_html = cached_metadata('search', query.upper(), args.cache_ttl * 3600)
 
-  cancellable()
-  freeze_support()
-  init_console_colors()
-  
-  # PARSE ARGS
-
-  set_args()
-
-  check_version()
-
-  MANGA_DIR = strip_path(args.directory, DIRECTORY_KEEP)
+  if search_html is None:
+    try:
+      # Alternative Search: https://inmanga.com/OnMangaQuickSearch/Source/QSMangaList.json
+      with stage('search'):
+        search = request('POST', SEARCH_URL, data=data, headers=headers)
+      exit_if_fails(search)
+    except requests.exceptions.ConnectionError:
+      network_error()
+    search_html = search.text
+    cache_metadata('search', query.upper(), search_html)
+    save_metadata()
+
+  with stage('parse_search'):
+    return parse_search(search_html)
+
+def catalog_path():
+  return f'{MANGA_DIR}/.catalog.json'
+
+def parse_catalog(content):
+  # [(uuid, title)], the catalog has no directory names of the mangas
+  mangas = []
+  for entry in json.loads(content):
+    title, uuid = entry.get('Name'), entry.get('Identification')
+    if title and uuid:
+      mangas.append((uuid, title))
+  return mangas
+
+def online_catalog():
+  # { mangas: [(uuid, title)], index: search index } of all the mangas of the provider, requested again after --cache-ttl hours
+  # None if the catalog cannot be retrieved, an expired catalog is still used then
+  catalog = read_json(catalog_path())
+  if catalog is not None and 'mangas' not in catalog:
+    catalog = None # written by a previous version
+  if catalog is not None and not args.refresh and time.time() - catalog['time'] <= args.cache_ttl * 3600:
+    count('cache_hits')
+    return catalog
+  count('cache_misses')
+  try:
+    with stage('catalog'):
+      response = get(CATALOG_URL, headers=COMPRESSED_HEADERS)
+    if response.status_code == 200:
+      mangas = parse_catalog(response.content)
+      if mangas:
+        # indexed once, so searches do not need to process the whole catalog
+        catalog = { 'time': time.time(), 'mangas': mangas, 'index': search_index([title for _, title in mangas]) }
+        write_json(catalog_path(), catalog)
+        return catalog
+  except (requests.exceptions.RequestException, ValueError, AttributeError):
+    pass
+  return catalog
+
+def catalog_manga(title, uuid):
+  # directory name of a manga found in the catalog, the one already downloaded or the one of the provider
+  # never made from the title, so the same manga is always in the same directory
+  for manga in load_library():
+    if normalize_title(decode(manga)) == normalize_title(title):
+      return manga
+  for href, _ in online_search(title):
+    if href.split('/')[-1] == uuid:
+      return href.split('/')[-2]
+  not_found()
+
+def normalize_title(title):
+  # lowercase words without accents nor punctuation
+  title = unicodedata.normalize('NFKD', title)
+  title = ''.join(c for c in title if not unicodedata.combining(c))
+  return ' '.join(re.sub(r'[\W_]+', ' ', title.lower()).split())
+
+def trigrams(normalized_title):
+  words = [f'  {word} ' for word in normalized_title.split()]
+  return { word[i:i+3] for word in words for i in range(len(word) - 2) }
+
+def search_index(titles):
+  # trigrams: { trigram: [title index] }, so only the titles sharing some trigram with the query are scored
+  normalized_titles = [normalize_title(title) for title in titles]
+  index = { 'trigrams': {}, 'sizes': [], 'titles': normalized_titles }
+  for i, title in enumerate(normalized_titles):
+    title_trigrams = trigrams(title)
+    index['sizes'].append(len(title_trigrams))
+    for trigram in title_trigrams:
+      index['trigrams'].setdefault(trigram, []).append(i)
+  return index
+
+SEARCH_MIN_SIMILARITY = 0.3
+
+def rank_titles(index, query, limit=10):
+  # indexes of the titles most similar to the query, best first
+  # titles containing the query come first, then by ratio of shared trigrams
+  query = normalize_title(query)
+  query_trigrams = trigrams(query)
+  shared = {}
+  for trigram in query_trigrams:
+    for i in index['trigrams'].get(trigram, []):
+      shared[i] = shared.get(i, 0) + 1
+  scores = []
+  for i, common in shared.items():
+    title = index['titles'][i]
+    similarity = common / (len(query_trigrams) + index['sizes'][i] - common)
+    if title == query:
+      similarity += 2
+    elif query in title or title in query:
+      similarity += 1
+    if similarity >= SEARCH_MIN_SIMILARITY:
+      scores.append((-similarity, title, i))
+  return [i for _, _, i in sorted(scores)[:limit]]
+
+def download_manga():
+  # one manga with the current args, returns the chapters downloaded or converted
+  global MANGA_DIR, METADATA, LIBRARY, MANGA, manga, manga_title, manga_uuid, directory, CHAPTERS_IDS
+
+  manga_dir = strip_path(args.directory, DIRECTORY_KEEP)
+  if manga_dir != MANGA_DIR:
+    # batch jobs in another directory
+    MANGA_DIR = manga_dir
+    METADATA = None
+    LIBRARY = None
+
+  if args.sync and args.cache:
+    error('--sync cannot be used with --cache')
 
   if not args.profile:
     args.profile = 'KPW'
 
+  if args.prescale and not args.cache:
+    profile_size()
+
   MANGA = ' '.join(args.manga)
 
   # SEARCH ANIME
@@ -510,43 +1990,36 @@ if __name__ == "__main__":
   search_type = f'in {MANGA_DIR}' if args.cache else 'online'
   print_colored(f"Searching '{MANGA}' {search_type}...", Style.BRIGHT)
 
-  results = []
-  match = False
   if args.cache: # offline search
-    encoded_title = encode(MANGA).upper()
-    for cached in folders(MANGA_DIR):
-      manga = cached[0]
-      encoded_cached = manga.upper()
-      manga_title = decode(manga)
-      if encoded_title == encoded_cached:
-        match = True
-        break
-      elif encoded_cached in encoded_title or encoded_title in encoded_cached:
-        results.append(manga_title)
-        submatch_manga = manga
+    if not os.path.isdir(MANGA_DIR):
+      error(f'{MANGA_DIR} does not exist')
+    library = list(load_library())
+    with stage('search'):
+      results = [(library[i], decode(library[i]), None) for i in rank_titles(search_index(map(decode, library)), MANGA)]
   else: # online search
-    for result in online_search():
-      manga_href = result.get('href')
-      if manga_href is None:
-        not_found()
-      manga = manga_href.split('/')[-2] # encoded title
-      manga_uuid = manga_href.split('/')[-1]
-      manga_title = result.find('h4').get_text().strip() # may contain special characters
-      if manga_title.upper() == MANGA.upper():
-        match = True
-        break
-      results.append(manga_title)
-
-  if not match:
-    if len(results) > 1:
-      upper_titles = [title.upper() for title in results]
-      error('There are several results, please select one of these:\n' + '\n'.join(upper_titles))
-    elif len(results) == 1:
-      manga_title = results[0]
-      if args.cache:
-        manga = submatch_manga
-    else:
-      not_found()
+    results = []
+    catalog = online_catalog()
+    if catalog:
+      with stage('search'):
+        # directory names are resolved once the manga is selected
+        results = [(None, title, uuid) for uuid, title in (catalog['mangas'][i] for i in rank_titles(catalog['index'], MANGA))]
+    # unknown titles are searched in the provider, the catalog may be outdated
+    if not results or normalize_title(results[0][1]) != normalize_title(MANGA):
+      online_results = online_search(MANGA)
+      if online_results and online_results[0][0]:
+        results = [(href.split('/')[-2], title, href.split('/')[-1]) for href, title in online_results] # title may contain special characters
+
+  match = [result for result in results if normalize_title(result[1]) == normalize_title(MANGA)]
+  if match:
+    results = match[:1]
+  if len(results) > 1:
+    upper_titles = [title.upper() for _, title, _ in results]
+    error('There are several results, please select one of these:\n' + '\n'.join(upper_titles))
+  elif not results:
+    not_found()
+  manga, manga_title, manga_uuid = results[0] # manga is the encoded title
+  if manga is None:
+    manga = catalog_manga(manga_title, manga_uuid)
 
   print_colored(manga_title, Fore.BLUE)
 
@@ -555,15 +2028,9 @@ if __name__ == "__main__":
   directory = os.path.abspath(manga_directory(manga))
 
   if args.cache:
-    ALL_CHAPTERS = [float(chapter[0]) for chapter in folders(directory)]
+    ALL_CHAPTERS = [float(chapter) for chapter in library_chapters(manga)]
   else:
-    try:
-      chapters_json = SCRAPER.get(CHAPTERS_WEBSITE + manga_uuid)
-      exit_if_fails(chapters_json)
-    except requests.exceptions.ConnectionError:
-      network_error()
-    chapters_full = load_json(chapters_json.content, 'data', 'result')
-    CHAPTERS_IDS = { float(chapter['Number']): chapter['Identification'] for chapter in chapters_full }
+    CHAPTERS_IDS = { float(number): chapter_id for number, chapter_id in online_chapters(manga_uuid) }
     ALL_CHAPTERS = CHAPTERS_IDS.keys()
 
   if not ALL_CHAPTERS:
@@ -577,6 +2044,16 @@ if __name__ == "__main__":
 
   CHAPTERS, chapters_not_found_intervals = chapters_in_intervals(ALL_CHAPTERS, CHAPTER_INTERVALS)
 
+  if args.sync:
+    last_synced = synced_chapter(manga)
+    if last_synced is not None:
+      CHAPTERS = [chapter for chapter in CHAPTERS if chapter > last_synced]
+      chapters_not_found_intervals = [(start, end) for start, end in chapters_not_found_intervals if end > last_synced]
+      if not CHAPTERS:
+        print_colored(f'Up to date. Last synced chapter: {last_synced:g}', Fore.GREEN, Style.BRIGHT)
+        exit()
+      print_colored(f'Last synced chapter: {last_synced:g}', Fore.YELLOW, Style.BRIGHT)
+
   if args.cache:
     print_colored(f'Last downloaded chapter: {last:g}', Fore.YELLOW, Style.BRIGHT)
   else:
@@ -588,89 +2065,108 @@ if __name__ == "__main__":
     print_colored(f'The following chapters {not_found}: {chapters_not_found_intervals}', Fore.RED, Style.BRIGHT)
     if args.cache:
       error(f'Please download those chapters first.', 'Try again this command without --cache')
-    else:
+    elif not args.sync and not args.batch: # unattended
       print_colored('🖐️  Press enter to continue without those chapters or Ctrl+C to abort...', Fore.MAGENTA, Style.BRIGHT, end=' ')
       input()
   
   if not CHAPTERS:
     error("No chapters found")
 
-  if not args.cache:
-    # DOWNLOAD CHAPTERS
+  extension = f'.{args.format.lower()}'
+  args.format = args.format.upper()
+
+  # chapters are converted while the next chapters are downloaded if --pipeline
+  args.pipeline = args.pipeline and not args.cache and not args.single and args.format != 'PNG'
 
-    for chapter in CHAPTERS:
-      print_colored(f'Downloading {manga_title} {chapter:g}', Fore.YELLOW, Style.BRIGHT)
+  COMPLETED_CHAPTERS = []
 
-      url = CHAPTER_PAGES_WEBSITE + CHAPTERS_IDS[chapter]
+  if args.cache:
+    DOWNLOADED_CHAPTERS = CHAPTERS
+  else:
+    # DOWNLOAD CHAPTERS
 
-      chapter_dir = chapter_directory(manga, chapter)
+    DOWNLOADED_CHAPTERS = download_chapters(manga, CHAPTERS, COMPLETED_CHAPTERS)
+
+    if not args.pipeline:
       try:
-        page = SCRAPER.get(url)
-
-        if success(page, print_ok=False):
-          html = BeautifulSoup(page.content, 'html.parser')
-          pages = html.find(id='PageList').find_all(True, recursive=False)
-          for page in pages:
-            page_id = page.get('value')
-            page_number = int(page.get_text())
-            url = IMAGE_WEBSITE + page_id
-            download(page_number, url, chapter_dir, text=f'Page {page_number}/{len(pages)} ({100*page_number//len(pages)}%)')
+        with stage('download'):
+          DOWNLOADED_CHAPTERS = list(DOWNLOADED_CHAPTERS)
       except requests.exceptions.ConnectionError:
         network_error()
 
-  extension = f'.{args.format.lower()}'
-  args.format = args.format.upper()
-
   if args.format != 'PNG':
+    # corrupted pages are found before converting
+    if args.pipeline:
+      DOWNLOADED_CHAPTERS = verified_chapters(DOWNLOADED_CHAPTERS)
+    else:
+      try:
+        with stage('verify_pages'):
+          verify_chapters(DOWNLOADED_CHAPTERS)
+          save_library()
+      except requests.exceptions.ConnectionError:
+        network_error()
+
     print_colored(f'Converting to {args.format}...', Fore.BLUE, Style.BRIGHT)
 
-    if args.format == 'PDF':
-      import img2pdf
-      if args.remove_alpha:
-        import wand.image
-      chapters_paths = []
-      for chapter in CHAPTERS:
-        chapter_dir = chapter_directory(manga, chapter)
-        page_number_paths = sorted(list(files(chapter_dir, 'png')), key=lambda page_path: int(page_path[0]))
-        page_paths = list(map(lambda page_path: page_path[1], page_number_paths))
+    with stage('conversion'):
+      if args.format == 'PDF':
+        import img2pdf
+        if args.remove_alpha:
+          import wand.image
         if args.single:
-          chapters_paths.extend(page_paths)
+          chapters_paths = []
+          for chapter in CHAPTERS:
+            chapters_paths.extend(chapter_pages_paths(chapter))
+          chapter_interval = chapters_to_intervals_string(CHAPTERS)
+          convert_to_pdf(output_path(chapter_interval, extension), chapters_paths)
         else:
-          path = f'{MANGA_DIR}/{manga_title} {chapter:g}{extension}'
-          convert_to_pdf(path, page_paths)
-      if args.single:
-        chapter_interval = chapters_to_intervals_string(CHAPTERS)
-        path = f'{MANGA_DIR}/{manga_title} {chapter_interval}{extension}'
-        convert_to_pdf(path, chapters_paths)
-    else:
-      # CONVERT TO E-READER FORMAT
-      from kindlecomicconverter.comic2ebook import main as manga2ebook
+          try:
+            convert_chapters(convert_chapter_to_pdf, DOWNLOADED_CHAPTERS, extension)
+          except requests.exceptions.ConnectionError:
+            network_error()
+      elif args.format == 'CBZ' and args.raw:
+        if args.single:
+          chapters_paths = []
+          for chapter in CHAPTERS:
+            chapters_paths.extend(chapter_pages_paths(chapter))
+          chapter_interval = chapters_to_intervals_string(CHAPTERS)
+          convert_to_cbz(output_path(chapter_interval, extension), f'{manga_title} {chapter_interval}', chapters_paths)
+        else:
+          try:
+            convert_chapters(convert_chapter_to_cbz, DOWNLOADED_CHAPTERS, extension)
+          except requests.exceptions.ConnectionError:
+            network_error()
+      else:
+        # CONVERT TO E-READER FORMAT
+        from kindlecomicconverter import comic2ebook
 
-      argv = ['--output', MANGA_DIR, '-p', args.profile, '--manga-style', '--hq', '-f', args.format, '--batchsplit', single(args.single), '-u', '-r', split_rotate_2_pages(args.rotate)]
+        argv = ['--output', MANGA_DIR, '-p', args.profile, '--manga-style', '--hq', '-f', args.format, '--batchsplit', single(args.single), '-u', '-r', split_rotate_2_pages(args.rotate)]
       
-      if not args.fullsize:
-        argv.append('-s')
-
-      if args.single:
-        chapter_interval = chapters_to_intervals_string(CHAPTERS)
-        with tempfile.TemporaryDirectory() as temp:
-          copy_all([(chapter, chapter_directory(manga, chapter)) for chapter in CHAPTERS], temp)
-          title = f'{manga_title} {chapter_interval}'
-          print_colored(title, Fore.BLUE)
-          argv = argv + ['--title', title, temp] # all chapters in manga directory are packed
-          cache_convert(argv)
-          path = f'{MANGA_DIR}/{manga_title} {chapter_interval}{extension}'
-          os.rename(f'{MANGA_DIR}/{os.path.basename(temp)}{extension}', path)
-          print_colored(f'DONE: {os.path.abspath(path)}', Fore.GREEN, Style.BRIGHT)
-      else:
-        for chapter in CHAPTERS:
-          title = f'{manga_title} {chapter:g}'
-          print_colored(title, Fore.BLUE)
-          argv_chapter = argv + ['--title', title, chapter_directory(manga, chapter)]
-          cache_convert(argv_chapter)
-          path = f'{MANGA_DIR}/{manga_title} {chapter:g}{extension}'
-          os.rename(f'{MANGA_DIR}/{chapter:g}{extension}', path)
-          print_colored(f'DONE: {os.path.abspath(path)}', Fore.GREEN, Style.BRIGHT)
+        if not args.fullsize:
+          argv.append('-s')
+
+        if args.single:
+          chapter_interval = chapters_to_intervals_string(CHAPTERS)
+          # staged next to the chapters so files can be hardlinked
+          if args.processed_cache:
+            chapters_directories = [(chapter, processed_chapter(chapter, argv)) for chapter in CHAPTERS]
+            argv = argv + ['-n']
+          else:
+            chapters_directories = [(chapter, chapter_directory(manga, chapter)) for chapter in CHAPTERS]
+          with tempfile.TemporaryDirectory(dir=MANGA_DIR, prefix='.') as temp:
+            stage_all(chapters_directories, temp)
+            title = f'{manga_title} {chapter_interval}'
+            print_colored(title, Fore.BLUE)
+            argv = argv + ['--title', title, temp] # all chapters in manga directory are packed
+            cache_convert(argv)
+            path = f'{MANGA_DIR}/{manga_title} {chapter_interval}{extension}'
+            os.rename(f'{MANGA_DIR}/{os.path.basename(temp)}{extension}', path)
+            print_colored(f'DONE: {os.path.abspath(path)}', Fore.GREEN, Style.BRIGHT)
+        else:
+          try:
+            convert_chapters(convert_chapter_to_ebook, DOWNLOADED_CHAPTERS, extension, argv)
+          except requests.exceptions.ConnectionError:
+            network_error()
   else:
     if len(CHAPTERS) == 1:
       directory = os.path.abspath(chapter_directory(manga, CHAPTERS[0]))
@@ -678,3 +2174,94 @@ if __name__ == "__main__":
     else:
       chapter_intervals_info = f" ({chapters_to_intervals_string(CHAPTERS, interval_sep=', ')})"
     print_colored(f'DONE: {directory}{chapter_intervals_info}', Fore.GREEN, Style.BRIGHT)
+
+  if args.sync:
+    synced = last_completed(CHAPTERS, COMPLETED_CHAPTERS)
+    if synced is not None:
+      save_synced_chapter(manga, manga_title, manga_uuid, synced)
+      print_dim(f'Synced until chapter {synced:g}')
+
+  if not args.batch:
+    print_connection_stats()
+
+  return CHAPTERS
+
+def batch_jobs(path):
+  # [argv] of every job: lines with the arguments of manga.py, or a JSON list of argument strings or lists
+  try:
+    with open(path, encoding='utf-8') as handler:
+      if path.lower().endswith('.json'):
+        jobs = json.load(handler)
+      else:
+        jobs = [line for line in handler if line.strip() and not line.lstrip().startswith('#')]
+    return [shlex.split(job) if isinstance(job, str) else [str(arg) for arg in job] for job in jobs]
+  except (OSError, ValueError) as e:
+    error(f'Invalid batch file {path}: {e}')
+
+def run_batch(path):
+  # jobs share the session, caches and worker pools, a failed job does not stop the next jobs
+  global args
+  batch_args = args
+  jobs = batch_jobs(path)
+  download_pool()
+  convert_pool()
+  summary = []
+  for number, job_argv in enumerate(jobs, start=1):
+    title = ' '.join(job_argv)
+    print_colored(f'\n[{number}/{len(jobs)}] {title}', Fore.MAGENTA, Style.BRIGHT)
+    start = time.time()
+    chapters = None
+    try:
+      args = PARSER.parse_args(job_argv, namespace=argparse.Namespace(**vars(batch_args)))
+      if not args.manga:
+        error('Missing manga title')
+      title = ' '.join(args.manga)
+      chapters = download_manga()
+      failed = False
+    except SystemExit as e:
+      if e.code == CANCELLED:
+        raise
+      failed = e.code not in (None, 0)
+    except Exception as e:
+      print_colored(f'{type(e).__name__}: {e}', Fore.RED, Style.BRIGHT)
+      failed = True
+    summary.append((title, chapters, failed, time.time() - start))
+  args = batch_args
+
+  print_colored(f'\nBatch: {len(jobs) - sum(failed for _, _, failed, _ in summary)}/{len(jobs)} completed', Style.BRIGHT)
+  for title, chapters, failed, seconds in summary:
+    chapters_info = f' ({chapters_to_intervals_string(chapters, interval_sep=", ")})' if chapters else ''
+    if failed:
+      print_colored(f'FAILED {title} [{seconds:.1f}s]', Fore.RED)
+    else:
+      print_colored(f'DONE {title}{chapters_info} [{seconds:.1f}s]', Fore.GREEN)
+  print_connection_stats()
+  if any(failed for _, _, failed, _ in summary):
+    exit(1)
+
+if __name__ == "__main__":
+
+  cancellable()
+  freeze_support()
+  init_console_colors()
+  
+  # PARSE ARGS
+
+  set_args()
+
+  if args.metrics:
+    atexit.register(write_metrics)
+
+  atexit.register(save_session)
+
+  if not args.cache and not args.no_update_check:
+    check_version_background()
+
+  if args.batch:
+    run_batch(args.batch)
+  elif args.manga:
+    download_manga()
+
+  if args.gc:
+    MANGA_DIR = strip_path(args.directory, DIRECTORY_KEEP)
+    collect_garbage()